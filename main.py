@@ -1,7 +1,7 @@
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Request
+from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, RedirectResponse
 from pydantic import BaseModel
 import socketio
 from datetime import datetime, timedelta
@@ -15,13 +15,30 @@ import aiofiles
 import pytz
 import asyncio
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import functools
+import hashlib
+import time
+import copy
+import heapq
+import itertools
+import uuid
+import weakref
+import re
+import unicodedata
+import mimetypes
+import shutil
 import pyotp
-from PIL import Image
+from PIL import Image, ImageOps
 from cryptography.fernet import Fernet
 
 # Firebase imports
 import firebase_admin
 from firebase_admin import credentials, firestore, auth
+from google.api_core.exceptions import FailedPrecondition, NotFound
+
+from models import PrivacySettings
 
 import os
 from dotenv import load_dotenv
@@ -50,15 +67,15 @@ class SecurityUtils:
 
 class QRUtils:
     @staticmethod
-    def generate_qr_code(data: str, filename: str) -> str:
+    def render_png(data: str) -> bytes:
         qr = qrcode.QRCode(version=1, box_size=10, border=5)
         qr.add_data(data)
         qr.make(fit=True)
         
         img = qr.make_image(fill_color="black", back_color="white")
-        filepath = f"uploads/qr_{filename}.png"
-        img.save(filepath)
-        return filepath
+        buffer = BytesIO()
+        img.save(buffer, format='PNG')
+        return buffer.getvalue()
 
 class OTPUtils:
     @staticmethod
@@ -76,19 +93,39 @@ class OTPUtils:
         return totp.verify(token)
 
 class FileUtils:
+    # name: (bounding box, JPEG quality)
+    IMAGE_VARIANTS = {
+        'display': ((1920, 1080), 85),
+        'thumbnail': ((320, 320), 75),
+        'thumbnail_small': ((96, 96), 70)
+    }
+
     @staticmethod
-    def compress_image(file_path: str, quality: int = 85) -> str:
-        with Image.open(file_path) as img:
-            if img.mode in ("RGBA", "P"):
+    def create_variants(file_path: str, output_prefix: str) -> dict:
+        """Orientation-corrected JPEG variants without EXIF metadata; returns {variant: path}"""
+        outputs = {}
+        with Image.open(file_path) as source:
+            # Re-encoding an animation as a still would lose it, so GIFs only get thumbnails
+            animated = getattr(source, 'is_animated', False)
+            img = ImageOps.exif_transpose(source)
+            if img.mode in ("RGBA", "LA", "P"):
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, "white")
+                background.paste(img, mask=img.getchannel("A"))
+                img = background
+            elif img.mode != "RGB":
                 img = img.convert("RGB")
             
-            max_size = (1920, 1080)
-            img.thumbnail(max_size, Image.Resampling.LANCZOS)
-            
-            compressed_path = file_path.replace(".", "_compressed.")
-            img.save(compressed_path, "JPEG", quality=quality, optimize=True)
-            return compressed_path
-    
+            for name, (max_size, quality) in FileUtils.IMAGE_VARIANTS.items():
+                if animated and name == 'display':
+                    continue
+                variant = img.copy()
+                variant.thumbnail(max_size, Image.Resampling.LANCZOS)
+                variant_path = f"{output_prefix}_{name}.jpg"
+                variant.save(variant_path, "JPEG", quality=quality, optimize=True)
+                outputs[name] = variant_path
+        return outputs
+
     @staticmethod
     def get_file_type(filename: str) -> str:
         ext = filename.lower().split('.')[-1]
@@ -136,31 +173,125 @@ print("Firebase initialized successfully")
 
 # Create uploads directory if it doesn't exist
 os.makedirs('uploads', exist_ok=True)
+# Public base URL of stored media (e.g. a CDN in front of /uploads). Older URLs
+# written under a previous base stay recognised through UPLOADS_URL_ALIASES.
+UPLOADS_URL = os.getenv("UPLOADS_URL", "https://widechat.onrender.com/uploads").rstrip('/')
+UPLOADS_URL_PREFIXES = [UPLOADS_URL] + [
+    alias.strip().rstrip('/')
+    for alias in os.getenv("UPLOADS_URL_ALIASES", "https://widechat.onrender.com/uploads,/uploads").split(',')
+    if alias.strip()
+]
 
 # ==================== FIREBASE SERVICE CLASS ====================
+# The Firestore/Auth SDK is blocking, so every call is pushed onto a bounded
+# thread pool and capped with a timeout instead of running on the event loop.
+FIRESTORE_MAX_WORKERS = int(os.getenv("FIRESTORE_MAX_WORKERS", "32"))
+FIRESTORE_TIMEOUT = float(os.getenv("FIRESTORE_TIMEOUT", "10"))
+FIRESTORE_STREAM_TIMEOUT = float(os.getenv("FIRESTORE_STREAM_TIMEOUT", "30"))
+FIRESTORE_GET_ALL_CHUNK = 100
+FIRESTORE_BATCH_LIMIT = 500
+# A message write plus its two inbox entries, two search entries and its upload reference
+MESSAGE_WRITE_OPS = 6
+MESSAGES_PER_BATCH = FIRESTORE_BATCH_LIMIT // MESSAGE_WRITE_OPS
+
 class FirebaseService:
     def __init__(self):
         self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=FIRESTORE_MAX_WORKERS, thread_name_prefix="firestore")
+
+    async def call(self, func, *args, timeout: Optional[float] = None, **kwargs):
+        """Run a blocking SDK call on the Firestore thread pool"""
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        try:
+            return await asyncio.wait_for(future, timeout or FIRESTORE_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Firestore operation timed out: {getattr(func, '__qualname__', func)}")
+            raise HTTPException(status_code=504, detail="Database operation timed out")
+
+    async def get(self, doc_ref):
+        return await self.call(doc_ref.get)
+
+    async def stream(self, query, timeout: Optional[float] = None) -> list:
+        return await self.call(lambda: list(query.stream()), timeout=timeout or FIRESTORE_STREAM_TIMEOUT)
+
+    async def set(self, doc_ref, data: dict, merge: bool = False):
+        return await self.call(doc_ref.set, data, merge=merge)
+
+    async def update(self, doc_ref, data: dict):
+        return await self.call(doc_ref.update, data)
+
+    async def delete(self, doc_ref):
+        return await self.call(doc_ref.delete)
+
+    async def add(self, collection_ref, data: dict):
+        return await self.call(collection_ref.add, data)
+
+    async def get_all(self, doc_refs: list) -> list:
+        """Fetch many documents with batched get_all calls, chunks running concurrently"""
+        chunks = [doc_refs[i:i + FIRESTORE_GET_ALL_CHUNK] for i in range(0, len(doc_refs), FIRESTORE_GET_ALL_CHUNK)]
+        results = await asyncio.gather(*[
+            self.call(lambda chunk=chunk: list(self.db.get_all(chunk))) for chunk in chunks
+        ])
+        return [doc for docs in results for doc in docs]
+
+    async def get_users_by_ids(self, user_ids) -> dict:
+        """Resolve user references in bulk, de-duplicated; returns {id: user} for existing users"""
+        unique_ids = list(dict.fromkeys(user_id for user_id in user_ids if user_id))
+        docs = await self.get_all([self.db.collection('users').document(user_id) for user_id in unique_ids])
+        return {doc.id: {'id': doc.id, **doc.to_dict()} for doc in docs if doc.exists}
+
+    async def delete_query(self, query, on_progress=None, stage=None, ops_per_doc: int = 1, on_commit=None) -> int:
+        """Delete everything a query matches, one page per WriteBatch; returns the count deleted.
+
+        stage(batch, doc) may add up to ops_per_doc - 1 related writes per deleted document.
+        Deletes are conditioned on the update time read, so when two runs overlap
+        the losing page fails as a whole (its staged writes included) and is re-read.
+        Side effects outside Firestore belong in on_commit(docs), which only sees
+        pages that committed.
+        """
+        deleted = 0
+        while True:
+            docs = await self.stream(query.limit(FIRESTORE_BATCH_LIMIT // ops_per_doc))
+            if not docs:
+                return deleted
+            batch = self.db.batch()
+            for doc in docs:
+                if stage:
+                    stage(batch, doc)
+                batch.delete(doc.reference, option=self.db.write_option(last_update_time=doc.update_time))
+            try:
+                await self.call(batch.commit)
+            except (FailedPrecondition, NotFound):
+                continue
+            deleted += len(docs)
+            if on_commit:
+                await on_commit(docs)
+            if on_progress:
+                await on_progress(deleted)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
 
     async def create_user(self, user_data: dict) -> dict:
         user_ref = self.db.collection('users').document()
         user_data['id'] = user_ref.id
         user_data['created_at'] = datetime.utcnow()
         user_data['updated_at'] = datetime.utcnow()
-        user_ref.set(user_data)
+        await self.set(user_ref, user_data)
         return user_data
 
     async def get_user_by_email(self, email: str) -> Optional[dict]:
         users_ref = self.db.collection('users')
         query = users_ref.where('email', '==', email).limit(1)
-        docs = query.stream()
+        docs = await self.stream(query)
         for doc in docs:
             return {'id': doc.id, **doc.to_dict()}
         return None
 
     async def get_user_by_id(self, user_id: str) -> Optional[dict]:
         doc_ref = self.db.collection('users').document(user_id)
-        doc = doc_ref.get()
+        doc = await self.get(doc_ref)
         if doc.exists:
             return {'id': doc.id, **doc.to_dict()}
         return None
@@ -168,7 +299,9 @@ class FirebaseService:
     async def update_user(self, user_id: str, update_data: dict) -> bool:
         update_data['updated_at'] = datetime.utcnow()
         doc_ref = self.db.collection('users').document(user_id)
-        doc_ref.update(update_data)
+        await self.update(doc_ref, update_data)
+        auth_cache.invalidate_user(user_id)
+        connection_graph.invalidate(user_id)
         return True
 
     async def get_user_connections(self, user_id: str) -> List[dict]:
@@ -176,50 +309,422 @@ class FirebaseService:
         if not user or 'connections' not in user:
             return []
         
-        connections = []
-        for conn_id in user['connections']:
-            conn_user = await self.get_user_by_id(conn_id)
-            if conn_user:
-                connections.append(conn_user)
-        return connections
+        users = await self.get_users_by_ids(user['connections'])
+        return [users[conn_id] for conn_id in user['connections'] if conn_id in users]
 
     async def send_message(self, message_data: dict) -> dict:
         message_ref = self.db.collection('messages').document()
         message_data['id'] = message_ref.id
         message_data['timestamp'] = datetime.utcnow()
         message_data['status'] = 'sent'
-        message_ref.set(message_data)
+        message_data.setdefault('conversation_id', get_conversation_id(
+            message_data['sender_id'], message_data.get('receiver_id'), message_data.get('group_id')
+        ))
+        await self.set(message_ref, message_data)
         return message_data
 
+    def conversation_messages(self, conversation_id: str, descending: bool = False, since=None):
+        """Messages of one chat ordered by time (uses the conversation_id+timestamp index)"""
+        direction = firestore.Query.DESCENDING if descending else firestore.Query.ASCENDING
+        query = self.db.collection('messages').where('conversation_id', '==', conversation_id)
+        if since:
+            query = query.where('timestamp', '>', since)
+        return query \
+            .order_by('timestamp', direction=direction) \
+            .order_by(firestore.FieldPath.document_id(), direction=direction)
+
+    async def cleared_before(self, user_id: str, conversation_id: str):
+        """The user's own "cleared before" watermark for a chat, if they cleared it for themselves"""
+        inbox_doc = await self.get(self.inbox_ref(user_id, conversation_id))
+        return inbox_doc.to_dict().get('cleared_before') if inbox_doc.exists else None
+
     async def get_messages(self, user_id: str, other_user_id: str) -> List[dict]:
-        messages_ref = self.db.collection('messages')
-        # Use simple query without ordering to avoid index requirement
-        query = messages_ref.where('participants', 'array_contains', user_id)
-        docs = query.stream()
+        conversation_id = get_conversation_id(user_id, other_user_id)
+        query = self.conversation_messages(conversation_id, since=await self.cleared_before(user_id, conversation_id))
+        docs = await self.stream(query)
+        return [{'id': doc.id, **doc.to_dict()} for doc in docs]
+
+    async def get_messages_page(self, user_id: str, other_user_id: str, limit: int,
+                                before: Optional[str] = None, after: Optional[str] = None) -> dict:
+        """One page of a chat, oldest first, walking back from the latest message by default"""
+        conversation_id = get_conversation_id(user_id, other_user_id)
+        cursor = decode_message_cursor(after or before) if (after or before) else None
         
-        messages = []
-        for doc in docs:
-            msg_data = doc.to_dict()
-            if (msg_data.get('sender_id') == user_id and msg_data.get('receiver_id') == other_user_id) or \
-               (msg_data.get('sender_id') == other_user_id and msg_data.get('receiver_id') == user_id):
-                messages.append({'id': doc.id, **msg_data})
+        # Newer pages read forward from the cursor, everything else reads backward
+        since = await self.cleared_before(user_id, conversation_id)
+        query = self.conversation_messages(conversation_id, descending=not after, since=since)
+        if cursor:
+            query = query.start_after({
+                'timestamp': cursor[0],
+                firestore.FieldPath.document_id(): self.db.collection('messages').document(cursor[1])
+            })
+        docs = await self.stream(query.limit(limit + 1))
         
-        # Sort by timestamp in Python
-        messages.sort(key=lambda x: x.get('timestamp', datetime.min))
-        return messages
+        has_more = len(docs) > limit
+        messages = [{'id': doc.id, **doc.to_dict()} for doc in docs[:limit]]
+        if not after:
+            messages.reverse()
+        
+        older_available = has_more if not after else bool(messages)
+        return {
+            "messages": messages,
+            "has_more": has_more,
+            "next_cursor": encode_message_cursor(messages[0]) if messages and older_available else None,
+            "latest_cursor": encode_message_cursor(messages[-1]) if messages else after
+        }
+
+    # ---------- Derived data kept in step with messages ----------
+    def stage_message_created(self, batch, message_id: str, message: dict):
+        """Add the inbox, search and upload reference writes for a new message to a batch"""
+        self.stage_inbox_message(batch, message_id, message)
+        self.stage_index_message(batch, message_id, message)
+        self.stage_upload_refs(batch, [message.get('file_url')], 1)
 
-    async def search_messages(self, user_id: str, query: str) -> List[dict]:
-        messages_ref = self.db.collection('messages')
-        docs = messages_ref.where('participants', 'array_contains', user_id).stream()
+    def stage_message_removed(self, batch, message_id: str, message: dict):
+        """Drop a removed message's search entries and upload reference (up to 3 ops)"""
+        for user_id in set(message.get('participants', [])):
+            batch.delete(self.search_entry_ref(user_id, message_id))
+        self.stage_upload_refs(batch, [message.get('file_url')], -1)
+
+    async def message_edited(self, message_id: str, message: dict, new_text: str):
+        await asyncio.gather(
+            self.update_inbox_message(message_id, message, {'text': new_text[:INBOX_PREVIEW_LENGTH]}),
+            self.reindex_message(message_id, message, ' '.join(filter(None, [new_text, message.get('caption')])))
+        )
+
+    async def message_deleted(self, message_doc, message: dict) -> bool:
+        """Delete a message with its derived data; False if a concurrent write changed it first"""
+        batch = self.db.batch()
+        batch.delete(message_doc.reference, option=self.db.write_option(last_update_time=message_doc.update_time))
+        self.stage_message_removed(batch, message_doc.id, message)
+        try:
+            await self.call(batch.commit)
+        except (FailedPrecondition, NotFound):
+            return False
+        await self.refresh_inbox_entries(message_doc.id, message)
+        return True
+
+    async def delete_messages(self, query, on_progress=None) -> int:
+        """Delete the messages a query matches together with their derived data"""
+        return await self.delete_query(
+            query, on_progress=on_progress, ops_per_doc=4,
+            stage=lambda batch, doc: self.stage_message_removed(batch, doc.id, doc.to_dict())
+        )
+
+    # ---------- Upload references (uploads/{sha256}) ----------
+    def stage_upload_refs(self, batch, urls: list, delta: int):
+        """Adjust reference counts of the content-addressed uploads among urls"""
+        for digest in set(filter(None, map(upload_digest, urls))):
+            batch.set(self.db.collection('uploads').document(digest), {
+                'ref_count': firestore.Increment(delta),
+                'updated_at': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+
+    async def update_upload_refs(self, add: list = (), remove: list = ()):
+        batch = self.db.batch()
+        self.stage_upload_refs(batch, list(add), 1)
+        self.stage_upload_refs(batch, list(remove), -1)
+        await self.call(batch.commit)
+
+    async def conversation_cleared(self, conversation_id: str, participants: List[str]):
+        await asyncio.gather(self.clear_inbox_entries(conversation_id, participants), self.unindex_conversation(conversation_id))
+
+    # ---------- Inbox (users/{user_id}/inbox/{conversation_id}) ----------
+    def inbox_ref(self, user_id: str, conversation_id: str):
+        return self.db.collection('users').document(user_id).collection('inbox').document(conversation_id)
+
+    async def get_inbox(self, user_id: str) -> dict:
+        """All inbox entries of a user keyed by peer id"""
+        query = self.db.collection('users').document(user_id).collection('inbox')
+        docs = await self.stream(query)
+        return {doc.to_dict().get('peer_id'): doc.to_dict() for doc in docs}
+
+    async def conversations_backfilled_at(self):
+        """When backfill-conversations last stamped a page of messages, None if it never ran"""
+        checkpoint = await self.get(self.db.collection('migrations').document('conversation_ids'))
+        return checkpoint.to_dict().get('updated_at') if checkpoint.exists else None
+
+    def stage_inbox_message(self, batch, message_id: str, message: dict):
+        """Point both participants' inbox entries at a newly written message"""
+        sender_id, receiver_id = message['sender_id'], message['receiver_id']
+        preview = inbox_preview(message_id, message)
+        for owner_id, peer_id in ((sender_id, receiver_id), (receiver_id, sender_id)):
+            entry = {
+                'conversation_id': message['conversation_id'],
+                'peer_id': peer_id,
+                'last_message': preview,
+                'last_timestamp': preview['timestamp'],
+                'updated_at': firestore.SERVER_TIMESTAMP
+            }
+            if owner_id == receiver_id and owner_id != sender_id:
+                entry['unread_count'] = firestore.Increment(1)
+            batch.set(self.inbox_ref(owner_id, message['conversation_id']), entry, merge=True)
+
+    async def update_inbox_message(self, message_id: str, message: dict, updates: dict):
+        """Apply an edit to inbox previews that currently show this message"""
+        for owner_id in message.get('participants', []):
+            inbox_ref = self.inbox_ref(owner_id, message['conversation_id'])
+            inbox_doc = await self.get(inbox_ref)
+            if inbox_doc.exists and (inbox_doc.to_dict().get('last_message') or {}).get('id') == message_id:
+                await self.update(inbox_ref, {f'last_message.{key}': value for key, value in updates.items()})
+
+    async def latest_inbox_preview(self, conversation_id: str) -> Optional[dict]:
+        docs = await self.stream(self.conversation_messages(conversation_id, descending=True).limit(1))
+        return inbox_preview(docs[0].id, docs[0].to_dict()) if docs else None
+
+    async def rebuild_inbox_entry(self, owner_id: str, peer_id: str, conversation_id: str,
+                                  last_message: Optional[dict], summarized: bool = False) -> dict:
+        entry = {
+            'conversation_id': conversation_id,
+            'peer_id': peer_id,
+            'last_message': last_message,
+            'last_timestamp': last_message['timestamp'] if last_message else None,
+            'updated_at': firestore.SERVER_TIMESTAMP
+        }
+        if not last_message:
+            entry['unread_count'] = 0
+        if summarized:
+            entry['summarized_at'] = firestore.SERVER_TIMESTAMP
+        await self.set(self.inbox_ref(owner_id, conversation_id), entry, merge=True)
+        return entry
+
+    async def refresh_inbox_entries(self, message_id: str, message: dict):
+        """Re-point inbox previews that were showing a removed message"""
+        participants = message.get('participants', [])
+        latest = None
+        for owner_id in participants:
+            inbox_doc = await self.get(self.inbox_ref(owner_id, message['conversation_id']))
+            if not inbox_doc.exists or (inbox_doc.to_dict().get('last_message') or {}).get('id') != message_id:
+                continue
+            if latest is None:
+                latest = await self.latest_inbox_preview(message['conversation_id']) or {}
+            peer_id = next((p for p in participants if p != owner_id), owner_id)
+            await self.rebuild_inbox_entry(owner_id, peer_id, message['conversation_id'], latest or None)
+
+    async def clear_inbox_entries(self, conversation_id: str, participants: List[str]):
+        for owner_id in participants:
+            peer_id = next((p for p in participants if p != owner_id), owner_id)
+            await self.rebuild_inbox_entry(owner_id, peer_id, conversation_id, None)
+
+    async def clear_conversation_for(self, user_id: str, peer_id: str):
+        """Hide a chat's history from one participant by moving their watermark, leaving messages intact"""
+        conversation_id = get_conversation_id(user_id, peer_id)
+        await self.set(self.inbox_ref(user_id, conversation_id), {
+            'conversation_id': conversation_id,
+            'peer_id': peer_id,
+            'last_message': None,
+            'last_timestamp': None,
+            'unread_count': 0,
+            'cleared_before': firestore.SERVER_TIMESTAMP,
+            'updated_at': firestore.SERVER_TIMESTAMP
+        }, merge=True)
+
+    async def mark_inbox_read(self, user_id: str, peer_id: str):
+        conversation_id = get_conversation_id(user_id, peer_id)
+        await self.set(self.inbox_ref(user_id, conversation_id), {
+            'conversation_id': conversation_id,
+            'peer_id': peer_id,
+            'unread_count': 0
+        }, merge=True)
+
+    # ---------- User directory (user_directory/{user_id}) ----------
+    async def sync_directory_entry(self, user: dict):
+        """Publish a user to the searchable directory, or withdraw them if not discoverable"""
+        entry_ref = self.db.collection('user_directory').document(user['id'])
+        if not get_privacy_settings(user).public_discovery:
+            await self.delete(entry_ref)
+            return
+        await self.set(entry_ref, directory_entry(user))
+
+    async def remove_directory_entry(self, user_id: str):
+        await self.delete(self.db.collection('user_directory').document(user_id))
+
+    async def search_directory(self, query: str, exclude_user_id: Optional[str] = None,
+                               limit: Optional[int] = None) -> List[dict]:
+        limit = limit or USER_SEARCH_LIMIT
+        terms = search_words(query)
+        if not terms:
+            return []
         
-        results = []
-        for doc in docs:
-            msg_data = doc.to_dict()
-            if query.lower() in msg_data.get('message_text', '').lower():
-                results.append({'id': doc.id, **msg_data})
+        lookup = max(terms, key=len)[:SEARCH_MAX_PREFIX]
+        directory_query = self.db.collection('user_directory') \
+            .where('search_keys', 'array_contains', lookup) \
+            .order_by('name_key') \
+            .limit(USER_SEARCH_CANDIDATE_LIMIT)
+        entries = await self.stream(directory_query)
         
+        results = []
+        for entry in entries:
+            entry_data = entry.to_dict()
+            if entry.id == exclude_user_id or not score_search_match(terms, entry_data.get('words', [])):
+                continue
+            results.append({key: entry_data.get(key) for key in DIRECTORY_FIELDS})
+            if len(results) >= limit:
+                break
         return results
 
+    # ---------- Message search index (search_index/{user_id}_{message_id}) ----------
+    def search_entry_ref(self, user_id: str, message_id: str):
+        return self.db.collection('search_index').document(f"{user_id}_{message_id}")
+
+    def stage_index_message(self, batch, message_id: str, message: dict):
+        """Write a search entry for every participant of a new message"""
+        text = ' '.join(filter(None, [message.get('message_text'), message.get('caption')]))
+        for user_id in set(message.get('participants', [])):
+            batch.set(self.search_entry_ref(user_id, message_id), {
+                'user_id': user_id,
+                'message_id': message_id,
+                'conversation_id': message.get('conversation_id'),
+                'words': search_words(text),
+                'tokens': search_tokens(text),
+                'timestamp': message.get('timestamp', firestore.SERVER_TIMESTAMP)
+            })
+
+    async def reindex_message(self, message_id: str, message: dict, text: str):
+        batch = self.db.batch()
+        for user_id in set(message.get('participants', [])):
+            batch.set(self.search_entry_ref(user_id, message_id), {
+                'words': search_words(text),
+                'tokens': search_tokens(text)
+            }, merge=True)
+        await self.call(batch.commit)
+
+    async def unindex_conversation(self, conversation_id: str, user_id: Optional[str] = None) -> int:
+        query = self.db.collection('search_index').where('conversation_id', '==', conversation_id)
+        if user_id:
+            query = query.where('user_id', '==', user_id)
+        return await self.delete_query(query)
+
+    async def search_messages(self, user_id: str, query: str, limit: int = 20, offset: int = 0) -> dict:
+        """Ranked message search over the user's token index"""
+        terms = search_words(query)
+        if not terms:
+            return {'results': [], 'has_more': False}
+        
+        # The longest term is the most selective lookup key; the rest are checked here
+        lookup = max(terms, key=len)[:SEARCH_MAX_PREFIX]
+        index_query = self.db.collection('search_index') \
+            .where('user_id', '==', user_id) \
+            .where('tokens', 'array_contains', lookup) \
+            .order_by('timestamp', direction=firestore.Query.DESCENDING) \
+            .limit(SEARCH_CANDIDATE_LIMIT)
+        entries = await self.stream(index_query)
+        
+        ranked = []
+        for entry in entries:
+            entry_data = entry.to_dict()
+            score = score_search_match(terms, entry_data.get('words', []))
+            if score:
+                ranked.append((score, entry_data['message_id']))
+        # Stable sort keeps newest-first order among equal scores
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        
+        page = [message_id for _, message_id in ranked[offset:offset + limit]]
+        docs = await self.get_all([self.db.collection('messages').document(message_id) for message_id in page])
+        found = {doc.id: {'id': doc.id, **doc.to_dict()} for doc in docs if doc.exists}
+        return {
+            'results': [found[message_id] for message_id in page if message_id in found],
+            'has_more': len(ranked) > offset + limit
+        }
+
+# Search tokenization: NFKD + accent stripping + casefold, then word prefixes
+SEARCH_MIN_PREFIX = 2
+SEARCH_MAX_PREFIX = 12
+SEARCH_MAX_TOKENS = 500
+SEARCH_CANDIDATE_LIMIT = 200
+
+def normalize_search_text(text: str) -> str:
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(ch for ch in text if not unicodedata.combining(ch)).casefold()
+
+def search_words(text: str) -> List[str]:
+    return list(dict.fromkeys(re.findall(r'\w+', normalize_search_text(text))))
+
+def search_tokens(text: str) -> List[str]:
+    """Words plus their prefixes, as stored in the index"""
+    tokens = {}
+    for word in search_words(text):
+        tokens[word] = True
+        for length in range(SEARCH_MIN_PREFIX, min(len(word), SEARCH_MAX_PREFIX) + 1):
+            tokens[word[:length]] = True
+        if len(tokens) >= SEARCH_MAX_TOKENS:
+            break
+    return list(tokens)[:SEARCH_MAX_TOKENS]
+
+def score_search_match(terms: List[str], words: List[str]) -> int:
+    """Every term must match a word exactly (2 points) or as a prefix (1 point)"""
+    score = 0
+    for term in terms:
+        if term in words:
+            score += 2
+        elif any(word.startswith(term) for word in words):
+            score += 1
+        else:
+            return 0
+    return score
+
+USER_SEARCH_LIMIT = 20
+USER_SEARCH_CANDIDATE_LIMIT = 100
+DIRECTORY_FIELDS = ['id', 'name', 'email', 'profile_image_url', 'status_message']
+
+def get_privacy_settings(user: dict) -> PrivacySettings:
+    return PrivacySettings(**(user.get('privacy_settings') or {}))
+
+def directory_entry(user: dict) -> dict:
+    """Public directory record with normalized name/email prefix keys"""
+    searchable = ' '.join(filter(None, [user.get('name'), user.get('email')]))
+    entry = {key: user.get(key) for key in DIRECTORY_FIELDS}
+    entry.update({
+        'name_key': normalize_search_text(user.get('name') or ''),
+        'words': search_words(searchable),
+        'search_keys': search_tokens(searchable)
+    })
+    return entry
+
+def get_conversation_id(user_id: str, other_user_id: Optional[str] = None, group_id: Optional[str] = None) -> str:
+    """Deterministic key shared by every message of a chat (sorted pair or group)"""
+    if group_id:
+        return f"group_{group_id}"
+    return "_".join(sorted([user_id, other_user_id]))
+
+INBOX_PREVIEW_LENGTH = 200
+
+def inbox_preview(message_id: str, message: dict) -> dict:
+    """Last-message summary stored on inbox entries"""
+    return {
+        "id": message_id,
+        "text": (message.get('message_text') or '')[:INBOX_PREVIEW_LENGTH],
+        "timestamp": message.get('timestamp'),
+        "type": message.get('message_type'),
+        "sender_id": message.get('sender_id')
+    }
+
+def message_conversation(message: dict) -> dict:
+    """Fill in conversation_id/participants for messages stored before they existed"""
+    message = dict(message)
+    message.setdefault('participants', [message.get('sender_id'), message.get('receiver_id')])
+    if not message.get('conversation_id'):
+        message['conversation_id'] = get_conversation_id(
+            message.get('sender_id'), message.get('receiver_id'), message.get('group_id')
+        )
+    return message
+
+def encode_message_cursor(message: dict) -> str:
+    """Opaque pagination token for a message (timestamp + id)"""
+    timestamp = message.get('timestamp')
+    payload = {
+        'ts': timestamp.isoformat() if hasattr(timestamp, 'isoformat') else None,
+        'id': message['id']
+    }
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+def decode_message_cursor(cursor: str):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return datetime.fromisoformat(payload['ts']), payload['id']
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 # Create global instance
 def format_last_seen(last_seen_timestamp):
     """Format last seen timestamp like WhatsApp"""
@@ -257,18 +762,471 @@ def format_last_seen(last_seen_timestamp):
 
 firebase_service = FirebaseService()
 
-async def update_user_status(user_id: str, is_online: bool):
-    """Update user online status in Firestore"""
-    try:
-        user_ref = db.collection('users').document(user_id)
-        update_data = {'is_online': is_online}
+# ==================== PRESENCE ====================
+# Online state lives in memory; Firestore only sees transitions that have
+# settled for PRESENCE_DEBOUNCE seconds, written in batches by flush_presence.
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "5"))
+PRESENCE_DEBOUNCE = float(os.getenv("PRESENCE_DEBOUNCE", "10"))
+PRESENCE_TTL = float(os.getenv("PRESENCE_TTL", "60"))
+
+# Set REDIS_URL to share Socket.IO rooms and presence across workers and nodes
+REDIS_URL = os.getenv("REDIS_URL")
+NODE_ID = uuid.uuid4().hex
+
+class LocalPresenceStore:
+    """Presence for a single worker process"""
+    def __init__(self):
+        self.expiry = {}
+        self.devices = {}
+
+    async def touch(self, user_id: str):
+        self.expiry[user_id] = time.time() + PRESENCE_TTL
+
+    async def remove(self, user_id: str):
+        self.expiry.pop(user_id, None)
+
+    async def online_among(self, user_ids) -> set:
+        now = time.time()
+        return {user_id for user_id in user_ids if self.expiry.get(user_id, 0) > now}
+
+    async def set_devices(self, user_id: str, count: int):
+        if count:
+            self.devices[user_id] = count
+        else:
+            self.devices.pop(user_id, None)
+
+    async def device_count(self, user_id: str) -> int:
+        return self.devices.get(user_id, 0)
+
+    async def renew(self):
+        pass
+
+    async def close(self):
+        pass
+
+class RedisPresenceStore:
+    """Presence shared through Redis: one sorted set per user, member per node, score = expiry.
+
+    Device counts live in devices:{user_id}, one field per node, and only count
+    while that node's member of the presence set is live. A node keeps its
+    members live for as long as it holds devices, so a dead node's counts
+    lapse within PRESENCE_TTL.
+    """
+    def __init__(self, url: str):
+        import redis.asyncio as aioredis
+        self.redis = aioredis.from_url(url)
+        self.node_users = set()
+        self.renewed_at = 0.0
+
+    @staticmethod
+    def key(user_id: str) -> str:
+        return f"presence:{user_id}"
+
+    async def touch(self, user_id: str):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(self.key(user_id), {NODE_ID: time.time() + PRESENCE_TTL})
+            pipe.expire(self.key(user_id), int(PRESENCE_TTL) + 1)
+            pipe.expire(f"devices:{user_id}", int(PRESENCE_TTL) + 1)
+            await pipe.execute()
+
+    async def remove(self, user_id: str):
+        await self.redis.zrem(self.key(user_id), NODE_ID)
+
+    async def online_among(self, user_ids) -> set:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zcount(self.key(user_id), now, "+inf")
+            counts = await pipe.execute()
+        return {user_id for user_id, count in zip(user_ids, counts) if count}
+
+    async def set_devices(self, user_id: str, count: int):
+        """Record this node's device count in devices:{user_id}"""
+        key = f"devices:{user_id}"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if count:
+                self.node_users.add(user_id)
+                pipe.hset(key, NODE_ID, count)
+                pipe.zadd(self.key(user_id), {NODE_ID: time.time() + PRESENCE_TTL})
+                pipe.expire(key, int(PRESENCE_TTL) + 1)
+                pipe.expire(self.key(user_id), int(PRESENCE_TTL) + 1)
+            else:
+                self.node_users.discard(user_id)
+                pipe.hdel(key, NODE_ID)
+            await pipe.execute()
+
+    async def device_count(self, user_id: str) -> int:
+        """Devices across the nodes that are still live for this user"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(f"devices:{user_id}")
+            pipe.zrangebyscore(self.key(user_id), time.time(), "+inf")
+            counts, live_nodes = await pipe.execute()
+        live_nodes = set(live_nodes)
+        return sum(int(count) for node, count in counts.items() if node in live_nodes)
+
+    async def renew(self):
+        """Keep this node's members live for every user it holds devices for, heartbeats or not"""
+        if not self.node_users or time.time() - self.renewed_at < PRESENCE_TTL / 3:
+            return
+        self.renewed_at = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in self.node_users:
+                pipe.zadd(self.key(user_id), {NODE_ID: time.time() + PRESENCE_TTL})
+                pipe.expire(self.key(user_id), int(PRESENCE_TTL) + 1)
+                pipe.expire(f"devices:{user_id}", int(PRESENCE_TTL) + 1)
+            await pipe.execute()
+
+    async def close(self):
+        """Withdraw this node's counts so a restart leaves nothing behind"""
+        if self.node_users:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for user_id in self.node_users:
+                    pipe.hdel(f"devices:{user_id}", NODE_ID)
+                    pipe.zrem(self.key(user_id), NODE_ID)
+                await pipe.execute()
+            self.node_users.clear()
+        await self.redis.close()
+
+class PresenceEngine:
+    def __init__(self, store):
+        self.store = store
+        self.online = {}
+        self.last_seen = {}
+        self.persisted = {}
+        self.pending = {}
+
+    async def set_status(self, user_id: str, is_online: bool):
+        if is_online:
+            await self.store.touch(user_id)
+        else:
+            await self.store.remove(user_id)
         
+        if self.online.get(user_id) == is_online:
+            return
+        self.online[user_id] = is_online
         if not is_online:
-            update_data['last_seen'] = firestore.SERVER_TIMESTAMP
+            self.last_seen[user_id] = datetime.now(pytz.utc)
+        self.pending[user_id] = time.monotonic()
+
+    async def refresh(self, user_id: str):
+        """Keep a live user's shared presence from expiring"""
+        await self.store.touch(user_id)
+
+    async def overlay_many(self, users: List[dict]) -> List[dict]:
+        """Replace stored is_online/last_seen with live values from the presence store"""
+        online = await self.store.online_among(user_data['id'] for user_data in users)
+        for user_data in users:
+            user_data['is_online'] = user_data['id'] in online
+            if not user_data['is_online'] and user_data['id'] in self.last_seen:
+                user_data['last_seen'] = self.last_seen[user_data['id']]
+        return users
+
+    async def flush(self, force: bool = False):
+        """Persist settled transitions in WriteBatch chunks"""
+        now = time.monotonic()
+        due = [user_id for user_id, changed_at in self.pending.items() if force or now - changed_at >= PRESENCE_DEBOUNCE]
+        # Going offline here does not mean offline everywhere
+        online_elsewhere = await self.store.online_among(user_id for user_id in due if not self.online.get(user_id))
+        writes = []
+        for user_id in due:
+            self.pending.pop(user_id, None)
+            is_online = self.online[user_id]
+            if self.persisted.get(user_id) == is_online or user_id in online_elsewhere:
+                continue
+            update_data = {'is_online': is_online}
+            if not is_online:
+                update_data['last_seen'] = self.last_seen.get(user_id, datetime.now(pytz.utc))
+            writes.append((user_id, update_data))
+        
+        for i in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+            chunk = writes[i:i + FIRESTORE_BATCH_LIMIT]
+            batch = db.batch()
+            for user_id, update_data in chunk:
+                batch.update(db.collection('users').document(user_id), update_data)
+            try:
+                await firebase_service.call(batch.commit)
+            except Exception as e:
+                # One missing user fails the whole batch, so retry individually
+                print(f"Presence batch failed ({e}), writing individually")
+                for user_id, update_data in chunk:
+                    try:
+                        await firebase_service.update(db.collection('users').document(user_id), update_data)
+                    except Exception as user_error:
+                        print(f"Error updating user status for {user_id}: {user_error}")
+        
+        for user_id, update_data in writes:
+            self.persisted[user_id] = update_data['is_online']
+        # Offline users that are fully persisted no longer need to be tracked
+        for user_id in due:
+            if user_id not in self.pending and not self.online.get(user_id):
+                self.online.pop(user_id, None)
+                self.last_seen.pop(user_id, None)
+                self.persisted.pop(user_id, None)
+
+    async def shutdown(self):
+        """Persist everyone tracked by this process as offline"""
+        for user_id in [user_id for user_id, is_online in self.online.items() if is_online]:
+            await self.set_status(user_id, False)
+        await self.flush(force=True)
+        await self.store.close()
+
+presence = PresenceEngine(RedisPresenceStore(REDIS_URL) if REDIS_URL else LocalPresenceStore())
+
+async def update_user_status(user_id: str, is_online: bool):
+    """Record a presence change; Firestore is updated by flush_presence"""
+    await presence.set_status(user_id, is_online)
+
+# ==================== CACHE INVALIDATION ====================
+# Per-process caches (verified tokens, connection graph) drop a user's entries
+# when that user's document changes. With REDIS_URL set, the invalidation is
+# also published so every other worker and node drops its copy too.
+CACHE_INVALIDATION_CHANNEL = "cache-invalidation"
+
+class CacheInvalidationBus:
+    def __init__(self, url: Optional[str]):
+        self.redis = None
+        if url:
+            import redis.asyncio as aioredis
+            self.redis = aioredis.from_url(url)
+        self.node_id = NODE_ID
+        self.handlers = {}
+        self.tasks = set()
+
+    def register(self, kind: str, handler):
+        """handler(user_id) applies an invalidation published by another process"""
+        self.handlers[kind] = handler
+
+    def publish(self, kind: str, user_id: str):
+        if not self.redis:
+            return
+        task = asyncio.create_task(self.send(kind, user_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, kind: str, user_id: str):
+        try:
+            await self.redis.publish(CACHE_INVALIDATION_CHANNEL, json.dumps({'node': self.node_id, 'kind': kind, 'user_id': user_id}))
+        except Exception as e:
+            print(f"Error publishing {kind} invalidation for {user_id}: {e}")
+
+    async def listen(self):
+        """Background task applying invalidations from other processes; resubscribes after errors"""
+        if not self.redis:
+            return
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    event = json.loads(message['data'])
+                    handler = self.handlers.get(event['kind'])
+                    if handler and event['node'] != self.node_id:
+                        handler(event['user_id'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Cache invalidation listener error: {e}")
+                await asyncio.sleep(1)
+
+    async def close(self):
+        if self.redis:
+            await self.redis.close()
+
+cache_bus = CacheInvalidationBus(REDIS_URL)
+
+# Presence events go only to the user's connections, resolved from a cached graph
+CONNECTION_GRAPH_TTL = float(os.getenv("CONNECTION_GRAPH_TTL", "300"))
+
+class ConnectionGraph:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.nodes = {}
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        """{'connections': [...], 'privacy': PrivacySettings} for a user, cached for ttl seconds"""
+        node = self.nodes.get(user_id)
+        if node and node['expires_at'] > time.monotonic():
+            return node
         
-        user_ref.update(update_data)
+        users = await firebase_service.get_users_by_ids([user_id])
+        if user_id not in users:
+            self.nodes.pop(user_id, None)
+            return None
+        node = {
+            'connections': list(users[user_id].get('connections', [])),
+            'privacy': get_privacy_settings(users[user_id]),
+            'expires_at': time.monotonic() + self.ttl
+        }
+        self.nodes[user_id] = node
+        return node
+
+    def invalidate(self, user_id: str, publish: bool = True):
+        self.nodes.pop(user_id, None)
+        if publish:
+            cache_bus.publish('connection_graph', user_id)
+
+connection_graph = ConnectionGraph(CONNECTION_GRAPH_TTL)
+cache_bus.register('connection_graph', lambda user_id: connection_graph.invalidate(user_id, publish=False))
+
+async def emit_presence(event: str, user_id: str, payload: dict, skip_sid=None):
+    """Emit a presence event to the rooms of the user's connections only"""
+    try:
+        node = await connection_graph.get(user_id)
+        if not node or not node['connections'] or node['privacy'].last_seen_visibility == 'nobody':
+            return
+        rooms = [f"user_{conn_id}" for conn_id in node['connections']]
+        await sio.emit(event, payload, room=rooms, skip_sid=skip_sid)
     except Exception as e:
-        print(f"Error updating user status: {e}")
+        print(f"Error emitting {event} for {user_id}: {e}")
+
+async def flush_presence():
+    """Background task writing settled presence transitions"""
+    while True:
+        await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+        try:
+            await presence.store.renew()
+            await presence.flush()
+        except Exception as e:
+            print(f"Error flushing presence: {e}")
+
+# ==================== BACKGROUND JOBS ====================
+# Long-running work runs as an asyncio task; its status lives in jobs/{job_id}
+JOB_MAX_FAILURES = 500
+# A running job holds a lease that it renews after every page; an expired lease
+# means its process died, and the first process to claim it takes the job over
+JOB_STALE_AFTER = int(os.getenv("JOB_STALE_AFTER", "120"))
+
+def job_lease_expiry() -> datetime:
+    return datetime.now(pytz.utc) + timedelta(seconds=JOB_STALE_AFTER)
+
+def job_lease_expired(data: dict) -> bool:
+    expires_at = data.get('lease_expires_at')
+    # Jobs started before leases existed only carry updated_at
+    if not expires_at and data.get('updated_at'):
+        expires_at = data['updated_at'] + timedelta(seconds=JOB_STALE_AFTER)
+    return not expires_at or expires_at <= datetime.now(pytz.utc)
+
+@firestore.transactional
+def claim_job(transaction, job_ref) -> Optional[dict]:
+    """Take the lease of an abandoned running job; None if it ended or another process holds it"""
+    job_doc = job_ref.get(transaction=transaction)
+    data = job_doc.to_dict() if job_doc.exists else {}
+    if data.get('status') != 'running' or not job_lease_expired(data):
+        return None
+    lease = {'lease_owner': NODE_ID, 'lease_expires_at': job_lease_expiry(), 'updated_at': firestore.SERVER_TIMESTAMP}
+    transaction.update(job_ref, lease)
+    return {**data, **lease}
+
+class JobContext:
+    def __init__(self, job_ref, data: dict):
+        self.ref = job_ref
+        self.id = job_ref.id
+        self.data = data
+
+    async def update(self, **fields):
+        if 'failures' in fields:
+            fields['failure_count'] = len(fields['failures'])
+            fields['failures'] = fields['failures'][:JOB_MAX_FAILURES]
+        fields['updated_at'] = firestore.SERVER_TIMESTAMP
+        fields['lease_expires_at'] = job_lease_expiry()
+        self.data.update(fields)
+        await firebase_service.update(self.ref, fields)
+
+class JobTracker:
+    def __init__(self):
+        self.tasks = {}
+
+    async def start(self, job_type: str, owner_id: str, runner, **fields) -> str:
+        """Create a job document and run runner(job) in the background; returns the job id"""
+        job_ref = db.collection('jobs').document()
+        data = {
+            'type': job_type,
+            'owner_id': owner_id,
+            'status': 'running',
+            'processed': 0,
+            'failures': [],
+            'failure_count': 0,
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+            'lease_owner': NODE_ID,
+            'lease_expires_at': job_lease_expiry(),
+            **fields
+        }
+        await firebase_service.set(job_ref, data)
+        self.launch(JobContext(job_ref, data), runner)
+        return job_ref.id
+
+    def launch(self, job: JobContext, runner):
+        task = asyncio.create_task(self.run(job, runner))
+        self.tasks[job.id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job.id, None))
+
+    async def run(self, job: JobContext, runner):
+        try:
+            result = await runner(job)
+            await job.update(status='completed', **(result or {}))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            try:
+                await job.update(status='failed', error=str(e))
+            except Exception as update_error:
+                print(f"Could not record failure of job {job.id}: {update_error}")
+
+    async def claim_abandoned(self, job_type: str) -> List[JobContext]:
+        """Claim the running jobs of a type whose process stopped renewing their lease"""
+        try:
+            query = db.collection('jobs').where('type', '==', job_type).where('status', '==', 'running')
+            docs = await firebase_service.stream(query)
+        except Exception as e:
+            print(f"Could not look up abandoned {job_type} jobs: {e}")
+            return []
+        claimed = []
+        for doc in docs:
+            if doc.id in self.tasks or not job_lease_expired(doc.to_dict()):
+                continue
+            # Every worker runs this at startup; only the one whose claim commits relaunches the job
+            try:
+                data = await firebase_service.call(claim_job, db.transaction(), doc.reference)
+            except Exception as e:
+                print(f"Could not claim {job_type} job {doc.id}: {e}")
+                continue
+            if data:
+                claimed.append(JobContext(doc.reference, data))
+        return claimed
+
+    async def resume(self, job_type: str, runner):
+        """Relaunch jobs of a type that were left running by a stopped process"""
+        for job in await self.claim_abandoned(job_type):
+            print(f"Resuming {job_type} job {job.id}")
+            self.launch(job, runner)
+
+    async def fail_abandoned(self, job_type: str, error: str):
+        """Mark jobs of a type that cannot be safely rerun as failed once their process is gone"""
+        for job in await self.claim_abandoned(job_type):
+            print(f"Failing abandoned {job_type} job {job.id}")
+            try:
+                await job.update(status='failed', error=error)
+            except Exception as e:
+                print(f"Could not record failure of job {job.id}: {e}")
+
+    async def get(self, job_id: str, owner_id: str) -> Optional[dict]:
+        job_doc = await firebase_service.get(db.collection('jobs').document(job_id))
+        if not job_doc.exists or job_doc.to_dict().get('owner_id') != owner_id:
+            return None
+        return {'id': job_doc.id, **job_doc.to_dict()}
+
+    def shutdown(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+
+jobs = JobTracker()
 
 # Pydantic models
 class UserCreate(BaseModel):
@@ -287,6 +1245,7 @@ class MessageSend(BaseModel):
     reply_to_id: Optional[str] = None
     caption: Optional[str] = None
     file_url: Optional[str] = None
+    file_variants: Optional[dict] = None
     group_id: Optional[str] = None
     location_lat: Optional[float] = None
     location_lng: Optional[float] = None
@@ -304,6 +1263,11 @@ class BroadcastMessage(BaseModel):
     message_text: str
     message_type: str = "text"
     file_url: Optional[str] = None
+    file_variants: Optional[dict] = None
+
+class MessageForward(BaseModel):
+    message_ids: List[str]
+    recipient_ids: List[str]
 
 class NotificationCreate(BaseModel):
     user_id: str
@@ -330,30 +1294,20 @@ async def cleanup_inactive_users():
     """Background task to mark users offline if no heartbeat received"""
     while True:
         try:
-            current_time = get_indian_time()
+            # Only sessions whose deadline has passed are looked at
             inactive_users = []
-            
-            for user_id, session_data in online_users.items():
-                last_heartbeat = session_data.get('last_heartbeat')
-                if last_heartbeat:
-                    last_heartbeat_dt = datetime.fromisoformat(last_heartbeat.replace('Z', '+00:00'))
-                    if last_heartbeat_dt.tzinfo is None:
-                        last_heartbeat_dt = pytz.timezone('Asia/Kolkata').localize(last_heartbeat_dt)
-                    
-                    # Convert both to naive datetime for comparison
-                    current_naive = current_time.replace(tzinfo=None)
-                    last_heartbeat_naive = last_heartbeat_dt.replace(tzinfo=None)
-                    
-                    if (current_naive - last_heartbeat_naive).total_seconds() > 30:
-                        inactive_users.append(user_id)
+            for record in heartbeat_expiry.pop_expired(time.monotonic()):
+                _, last_device = sessions.remove(record.sid)
+                await presence.store.set_devices(record.user_id, sessions.device_count(record.user_id))
+                # Devices on other nodes keep the user online
+                if last_device and not await presence.store.device_count(record.user_id):
+                    inactive_users.append(record.user_id)
             
             for user_id in inactive_users:
-                online_users.pop(user_id, None)
-                user_sessions.pop(user_id, None)
                 await update_user_status(user_id, False)
                 
-                # Emit user offline status
-                await sio.emit('user_offline', {
+                # Emit user offline status to their connections
+                await emit_presence('user_offline', user_id, {
                     'user_id': user_id,
                     'last_seen': get_indian_time().isoformat() + 'Z'
                 })
@@ -361,14 +1315,25 @@ async def cleanup_inactive_users():
         except Exception as e:
             print(f"Error in cleanup task: {e}")
         
-        await asyncio.sleep(15)  # Check every 15 seconds
+        await asyncio.sleep(heartbeat_expiry.seconds_until_next(time.monotonic()))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     asyncio.create_task(cleanup_inactive_users())
+    asyncio.create_task(flush_presence())
+    asyncio.create_task(cache_bus.listen())
+    asyncio.create_task(recover_jobs())
+    asyncio.create_task(sweep_unreferenced_uploads())
+    asyncio.create_task(sweep_expired_upload_sessions())
+    asyncio.create_task(sweep_expired_statuses())
     yield
-    # Shutdown (if needed)
+    # Shutdown
+    jobs.shutdown()
+    media_pipeline.shutdown()
+    await presence.shutdown()
+    await cache_bus.close()
+    firebase_service.shutdown()
 
 # FastAPI app
 app = FastAPI(title="WideChat API", lifespan=lifespan)
@@ -380,6 +1345,93 @@ security_optional = HTTPBearer(auto_error=False)
 def get_indian_time():
     return datetime.utcnow()
 
+# Verified tokens and their user documents are cached so that most requests
+# skip both the remote revocation lookup and the users read.
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "300"))
+AUTH_REVOCATION_CHECK_INTERVAL = float(os.getenv("AUTH_REVOCATION_CHECK_INTERVAL", "60"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
+class AuthCache:
+    def __init__(self, ttl: float, revocation_interval: float, max_entries: int):
+        self.ttl = ttl
+        self.revocation_interval = revocation_interval
+        self.max_entries = max_entries
+        self.entries = {}
+        self.user_tokens = {}
+
+    @staticmethod
+    def token_key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self.token_key(token)
+        entry = self.entries.get(key)
+        if entry and entry['expires_at'] <= time.monotonic():
+            self.discard(token)
+            return None
+        return entry
+
+    def put(self, token: str, claims: dict, user: dict):
+        if len(self.entries) >= self.max_entries:
+            self.purge_expired()
+            if len(self.entries) >= self.max_entries:
+                self.discard_key(next(iter(self.entries)))
+        
+        now = time.monotonic()
+        # Never keep a token past its own expiry
+        token_lifetime = claims.get('exp', time.time() + self.ttl) - time.time()
+        key = self.token_key(token)
+        self.entries[key] = {
+            'claims': claims,
+            'user': user,
+            'expires_at': now + max(0, min(self.ttl, token_lifetime)),
+            'revocation_checked_at': now
+        }
+        self.user_tokens.setdefault(user['id'], set()).add(key)
+
+    def discard(self, token: str):
+        self.discard_key(self.token_key(token))
+
+    def discard_key(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry:
+            keys = self.user_tokens.get(entry['user']['id'])
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    self.user_tokens.pop(entry['user']['id'], None)
+
+    def invalidate_user(self, user_id: str, publish: bool = True):
+        """Drop every cached token for a user after their document changes"""
+        for key in list(self.user_tokens.pop(user_id, ())):
+            self.entries.pop(key, None)
+        if publish:
+            cache_bus.publish('auth', user_id)
+
+    def purge_expired(self):
+        now = time.monotonic()
+        for key in [k for k, e in self.entries.items() if e['expires_at'] <= now]:
+            self.discard_key(key)
+
+    async def verify(self, token: str):
+        """Return (claims, cached user or None), rechecking revocation when due"""
+        entry = self.get(token)
+        if entry is None:
+            decoded_token = await firebase_service.call(auth.verify_id_token, token, check_revoked=True)
+            return decoded_token, None
+        
+        if time.monotonic() - entry['revocation_checked_at'] >= self.revocation_interval:
+            try:
+                await firebase_service.call(auth.verify_id_token, token, check_revoked=True)
+            except Exception:
+                self.discard(token)
+                raise
+            entry['revocation_checked_at'] = time.monotonic()
+        return entry['claims'], entry['user']
+
+auth_cache = AuthCache(AUTH_CACHE_TTL, AUTH_REVOCATION_CHECK_INTERVAL, AUTH_CACHE_MAX_ENTRIES)
+cache_bus.register('auth', lambda user_id: auth_cache.invalidate_user(user_id, publish=False))
+
 async def get_current_user_optional(credentials: HTTPAuthorizationCredentials = Depends(security_optional)):
     """Optional authentication - returns None if no valid token"""
     try:
@@ -387,16 +1439,18 @@ async def get_current_user_optional(credentials: HTTPAuthorizationCredentials =
             return None
             
         token = credentials.credentials
-        decoded_token = auth.verify_id_token(token, check_revoked=True)
-        user_id = decoded_token['uid']
-        
-        user_doc = db.collection('users').document(user_id).get()
-        if not user_doc.exists:
-            return None
+        decoded_token, user_data = await auth_cache.verify(token)
         
-        user_data = user_doc.to_dict()
-        user_data['id'] = user_doc.id
-        return user_data
+        if user_data is None:
+            user_id = decoded_token['uid']
+            user_doc = await firebase_service.get(db.collection('users').document(user_id))
+            if not user_doc.exists:
+                return None
+            
+            user_data = user_doc.to_dict()
+            user_data['id'] = user_doc.id
+            auth_cache.put(token, decoded_token, user_data)
+        return copy.deepcopy(user_data)
     except Exception as e:
         print(f"Optional auth error: {str(e)}")
         return None
@@ -408,12 +1462,10 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
             raise HTTPException(status_code=401, detail="Authorization token required")
             
         token = credentials.credentials
-        print(f"Verifying token: {token[:20]}...")
         
         try:
-            decoded_token = auth.verify_id_token(token, check_revoked=True)
+            decoded_token, user_data = await auth_cache.verify(token)
             user_id = decoded_token['uid']
-            print(f"Token verified for user: {user_id}")
         except auth.InvalidIdTokenError as e:
             print(f"Invalid token error: {str(e)}")
             raise HTTPException(status_code=401, detail="Invalid authentication token")
@@ -427,15 +1479,20 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
             print(f"Token verification error: {str(e)}")
             raise HTTPException(status_code=401, detail="Token verification failed")
         
-        user_doc = db.collection('users').document(user_id).get()
-        if not user_doc.exists:
-            print(f"User document not found for: {user_id}")
-            raise HTTPException(status_code=404, detail="User not found")
+        if user_data is None:
+            print(f"Token verified for user: {user_id}")
+            user_doc = await firebase_service.get(db.collection('users').document(user_id))
+            if not user_doc.exists:
+                print(f"User document not found for: {user_id}")
+                raise HTTPException(status_code=404, detail="User not found")
+            
+            user_data = user_doc.to_dict()
+            user_data['id'] = user_doc.id
+            auth_cache.put(token, decoded_token, user_data)
+            print(f"User data retrieved successfully for: {user_id}")
         
-        user_data = user_doc.to_dict()
-        user_data['id'] = user_doc.id
-        print(f"User data retrieved successfully for: {user_id}")
-        return user_data
+        # Routes mutate the user dict, so never hand out the cached copy
+        return copy.deepcopy(user_data)
             
     except HTTPException:
         raise
@@ -460,7 +1517,7 @@ async def test_endpoint():
 async def health_check():
     try:
         # Test Firebase connection
-        test_doc = db.collection('test').document('health').get()
+        test_doc = await firebase_service.get(db.collection('test').document('health'))
         firebase_status = "connected"
     except Exception as e:
         firebase_status = f"error: {str(e)}"
@@ -481,11 +1538,12 @@ async def debug_auth():
     """Debug endpoint to test authentication"""
     try:
         # Test creating a test user
-        test_user = auth.create_user(
+        test_user = await firebase_service.call(
+            auth.create_user,
             email="test@example.com",
             password="testpass123"
         )
-        auth.delete_user(test_user.uid)  # Clean up
+        await firebase_service.call(auth.delete_user, test_user.uid)  # Clean up
         return {"auth_status": "working", "message": "Firebase Auth is functional"}
     except Exception as e:
         return {"auth_status": "error", "error": str(e)}
@@ -509,9 +1567,6 @@ async def debug_headers(request: Request):
 
 
 
-# Mount static files
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
-
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -531,23 +1586,122 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Socket.IO
-sio = socketio.AsyncServer(
-    cors_allowed_origins="*",
-    async_mode='asgi'
-)
+# Socket.IO - with REDIS_URL, emits to rooms reach clients on every worker/node
+def create_socket_server(redis_url: Optional[str]) -> socketio.AsyncServer:
+    """Socket.IO server; with a Redis URL, emits reach clients connected to any worker or node"""
+    return socketio.AsyncServer(
+        cors_allowed_origins="*",
+        async_mode='asgi',
+        client_manager=socketio.AsyncRedisManager(redis_url) if redis_url else None
+    )
+
+sio = create_socket_server(REDIS_URL)
 socket_app = socketio.ASGIApp(sio, app)
 
 # Online users tracking
-online_users = {}
-user_sessions = {}
+HEARTBEAT_TIMEOUT = 30
+HEARTBEAT_CHECK_INTERVAL = 15
+
+class SessionRecord:
+    """Compact per-session state; times are time.monotonic() seconds"""
+    __slots__ = ('user_id', 'sid', 'connected_at', 'last_heartbeat', 'active', 'armed')
+
+    def __init__(self, user_id: str, sid: str):
+        self.user_id = user_id
+        self.sid = sid
+        self.connected_at = time.monotonic()
+        self.last_heartbeat = self.connected_at
+        self.active = True
+        self.armed = False
+
+class HeartbeatExpiry:
+    """Min-heap of session deadlines with one entry per session.
+
+    Sessions are armed by their first heartbeat, so clients that never send
+    one stay until they disconnect. A popped entry whose session heartbeated
+    since it was pushed is re-armed with the new deadline, so later heartbeats
+    never touch the heap.
+    """
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.heap = []
+        self.counter = itertools.count()
+
+    def schedule(self, record: SessionRecord):
+        """Arm a session's deadline; a session that is already armed is left alone"""
+        if record.armed:
+            return
+        record.armed = True
+        heapq.heappush(self.heap, (record.last_heartbeat + self.timeout, next(self.counter), record))
+
+    def pop_expired(self, now: float) -> List[SessionRecord]:
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, record = heapq.heappop(self.heap)
+            if not record.active:
+                continue
+            deadline = record.last_heartbeat + self.timeout
+            if deadline > now:
+                heapq.heappush(self.heap, (deadline, next(self.counter), record))
+                continue
+            record.active = False
+            expired.append(record)
+        return expired
+
+    def seconds_until_next(self, now: float) -> float:
+        if not self.heap:
+            return HEARTBEAT_CHECK_INTERVAL
+        return min(max(self.heap[0][0] - now, 0.5), HEARTBEAT_CHECK_INTERVAL)
+
+class SessionRegistry:
+    """Socket sessions indexed both ways: user -> {sid: record} and sid -> record"""
+    def __init__(self):
+        self.by_sid = {}
+        self.by_user = {}
+
+    def add(self, user_id: str, sid: str):
+        """Register a device; returns (record, is_first_device)"""
+        existing = self.by_sid.get(sid)
+        if existing and existing.user_id == user_id:
+            return existing, False
+        if existing:
+            self.remove(sid)
+        
+        record = SessionRecord(user_id, sid)
+        devices = self.by_user.setdefault(user_id, {})
+        devices[sid] = record
+        self.by_sid[sid] = record
+        return record, len(devices) == 1
+
+    def remove(self, sid: str):
+        """Drop a device; returns (record or None, was_last_device)"""
+        record = self.by_sid.pop(sid, None)
+        if not record:
+            return None, False
+        record.active = False
+        devices = self.by_user.get(record.user_id, {})
+        devices.pop(sid, None)
+        if not devices:
+            self.by_user.pop(record.user_id, None)
+            return record, True
+        return record, False
+
+    def get(self, sid: str) -> Optional[SessionRecord]:
+        return self.by_sid.get(sid)
+
+    def device_count(self, user_id: str) -> int:
+        return len(self.by_user.get(user_id, ()))
+
+heartbeat_expiry = HeartbeatExpiry(HEARTBEAT_TIMEOUT)
+sessions = SessionRegistry()
 
 # Auth routes
 @app.post("/auth/register")
 async def register(user_data: UserCreate):
     try:
         # Create Firebase Auth user
-        firebase_user = auth.create_user(
+        firebase_user = await firebase_service.call(
+            auth.create_user,
             email=user_data.email,
             password=user_data.password,
             display_name=user_data.name
@@ -564,10 +1718,11 @@ async def register(user_data: UserCreate):
             "connections": []
         }
         
-        db.collection('users').document(firebase_user.uid).set(user_doc)
+        await firebase_service.set(db.collection('users').document(firebase_user.uid), user_doc)
+        await firebase_service.sync_directory_entry({'id': firebase_user.uid, **user_doc})
         
         # Generate custom token
-        custom_token = auth.create_custom_token(firebase_user.uid)
+        custom_token = await firebase_service.call(auth.create_custom_token, firebase_user.uid)
         
         return {
             "custom_token": custom_token.decode('utf-8'),
@@ -581,7 +1736,7 @@ async def login(user_data: UserLogin):
     try:
         # Get user by email from Firestore
         users_query = db.collection('users').where('email', '==', user_data.email).limit(1)
-        users = users_query.stream()
+        users = await firebase_service.stream(users_query)
         
         user_doc = None
         for user in users:
@@ -595,7 +1750,7 @@ async def login(user_data: UserLogin):
         user_data_dict['id'] = user_doc.id
         
         # Create custom token for the user
-        custom_token = auth.create_custom_token(user_doc.id)
+        custom_token = await firebase_service.call(auth.create_custom_token, user_doc.id)
         
         return {
             "custom_token": custom_token.decode('utf-8'),
@@ -620,9 +1775,76 @@ async def get_me(current_user = Depends(get_current_user)):
         "status_message": current_user['status_message'],
         "profile_image_url": current_user['profile_image_url'],
         "invite_code": current_user.get('invite_code', ''),
-        "connections_count": len(current_user.get('connections', []))
+        "connections_count": len(current_user.get('connections', [])),
+        "active_devices": await presence.store.device_count(current_user['id'])
     }
 
+# Invite QR codes only change with the invite code, so each one is rendered once
+# (off the event loop) and kept in an in-memory LRU backed by files in QR_CACHE_DIR.
+QR_CACHE_DIR = 'qr_cache'
+QR_CACHE_MAX_ENTRIES = int(os.getenv("QR_CACHE_MAX_ENTRIES", "1000"))
+os.makedirs(QR_CACHE_DIR, exist_ok=True)
+
+def invite_link(invite_code: str) -> str:
+    return f"https://widechatapp.web.app/?invite={invite_code}"
+
+class QRCodeCache:
+    def __init__(self, directory: str, max_entries: int):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.entries = {}
+        self.pending = {}
+
+    @staticmethod
+    def key(invite_code: str) -> str:
+        return hashlib.sha256(invite_link(invite_code).encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    async def get(self, invite_code: str) -> dict:
+        """{'png', 'etag', 'data_uri'} for an invite code, rendering it at most once"""
+        key = self.key(invite_code)
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.entries[key] = entry
+            return entry
+        # Concurrent misses for the same code share one render
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self.load(key, invite_code))
+            self.pending[key].add_done_callback(lambda _: self.pending.pop(key, None))
+        return await asyncio.shield(self.pending[key])
+
+    async def load(self, key: str, invite_code: str) -> dict:
+        path = self.path(key)
+        loop = asyncio.get_running_loop()
+        if os.path.exists(path):
+            async with aiofiles.open(path, 'rb') as f:
+                png = await f.read()
+        else:
+            png = await loop.run_in_executor(None, QRUtils.render_png, invite_link(invite_code))
+            temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            async with aiofiles.open(temp_path, 'wb') as f:
+                await f.write(png)
+            os.replace(temp_path, path)
+        
+        entry = {
+            'png': png,
+            'etag': f'"{key[:32]}"',
+            'data_uri': f"data:image/png;base64,{base64.b64encode(png).decode()}"
+        }
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.pop(next(iter(self.entries)))
+        return entry
+
+    def invalidate(self, invite_code: str):
+        key = self.key(invite_code)
+        self.entries.pop(key, None)
+        remove_quietly(self.path(key))
+
+qr_cache = QRCodeCache(QR_CACHE_DIR, QR_CACHE_MAX_ENTRIES)
+
 @app.get("/users/qr")
 async def get_qr_code(current_user = Depends(get_current_user)):
     """Generate QR code for user's invite code"""
@@ -630,18 +1852,23 @@ async def get_qr_code(current_user = Depends(get_current_user)):
     if not invite_code:
         raise HTTPException(status_code=404, detail="Invite code not found")
     
-    # Create QR code with web link
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(f"https://widechatapp.web.app/?invite={invite_code}")
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = BytesIO()
-    img.save(buffer, format='PNG')
-    buffer.seek(0)
+    qr_code = await qr_cache.get(invite_code)
+    return {"qr_code": qr_code['data_uri'], "etag": qr_code['etag']}
+
+@app.get("/users/qr.png")
+async def get_qr_code_png(request: Request, current_user = Depends(get_current_user)):
+    """The invite QR code as a cacheable image/png"""
+    invite_code = current_user.get('invite_code')
+    if not invite_code:
+        raise HTTPException(status_code=404, detail="Invite code not found")
     
-    img_str = base64.b64encode(buffer.getvalue()).decode()
-    return {"qr_code": f"data:image/png;base64,{img_str}"}
+    qr_code = await qr_cache.get(invite_code)
+    # The URL stays the same when the invite code changes, so clients revalidate every time
+    headers = {"ETag": qr_code['etag'], "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, qr_code['etag']):
+        return Response(status_code=304, headers=headers)
+    return Response(content=qr_code['png'], media_type="image/png", headers=headers)
 
 @app.put("/users/invite-code")
 async def update_invite_code(invite_data: dict, current_user = Depends(get_current_user)):
@@ -656,14 +1883,17 @@ async def update_invite_code(invite_data: dict, current_user = Depends(get_curre
     
     # Check if invite code already exists (excluding current user)
     users_query = db.collection('users').where('invite_code', '==', new_invite_code).limit(1)
-    existing_users = list(users_query.stream())
+    existing_users = await firebase_service.stream(users_query)
     
     if existing_users and existing_users[0].id != current_user['id']:
         raise HTTPException(status_code=409, detail="Invite code already taken")
     
     # Update user's invite code (keep existing connections intact)
     user_ref = db.collection('users').document(current_user['id'])
-    user_ref.update({'invite_code': new_invite_code})
+    await firebase_service.update(user_ref, {'invite_code': new_invite_code})
+    auth_cache.invalidate_user(current_user['id'])
+    if current_user.get('invite_code') and current_user['invite_code'] != new_invite_code:
+        qr_cache.invalidate(current_user['invite_code'])
     
     return {"message": "Invite code updated successfully", "invite_code": new_invite_code}
 
@@ -679,42 +1909,58 @@ async def get_connections(current_user = Depends(get_current_user)):
         connections = current_user.get('connections', [])
         print(f"User has {len(connections)} connections")
         
+        # One query for every conversation summary, one batched read for the users
+        inbox, users, backfilled_at = await asyncio.gather(
+            firebase_service.get_inbox(current_user['id']),
+            firebase_service.get_users_by_ids(connections),
+            firebase_service.conversations_backfilled_at()
+        )
+        
+        def needs_summary(entry: Optional[dict]) -> bool:
+            if entry is None:
+                return True
+            # An empty summary may predate conversation_id being stamped on older
+            # messages, so it is redone once backfill-conversations has run since
+            summarized_at = entry.get('summarized_at')
+            return (entry.get('last_message') is None and summarized_at is not None
+                    and backfilled_at is not None and summarized_at < backfilled_at)
+        
+        async def summarize(conn_id: str) -> dict:
+            # Conversations from before the inbox existed are summarised once; an
+            # empty result is stored as a marker so it is not looked up every time
+            conversation_id = get_conversation_id(current_user['id'], conn_id)
+            latest = await firebase_service.latest_inbox_preview(conversation_id)
+            return await firebase_service.rebuild_inbox_entry(
+                current_user['id'], conn_id, conversation_id, latest, summarized=True
+            )
+        
+        stale = [conn_id for conn_id in connections if conn_id in users and needs_summary(inbox.get(conn_id))]
+        summaries, _ = await asyncio.gather(
+            asyncio.gather(*(summarize(conn_id) for conn_id in stale), return_exceptions=True),
+            presence.overlay_many(list(users.values()))
+        )
+        for conn_id, summary in zip(stale, summaries):
+            if isinstance(summary, Exception):
+                print(f"Error summarising conversation with {conn_id}: {str(summary)}")
+                summary = {'last_message': None, 'unread_count': 0}
+            inbox[conn_id] = summary
+        
         connected_users = []
-        for conn_id in connections:
+        for conn_id in list(connections):
             try:
-                user_doc = db.collection('users').document(conn_id).get()
-                if user_doc.exists:
-                    user_data = user_doc.to_dict()
-                    user_data['id'] = user_doc.id
-                    
-                    # Format last seen
-                    if user_data.get('is_online'):
+                user_data = users.get(conn_id)
+                if user_data:
+                    # Format last seen, honouring the connection's privacy settings
+                    if get_privacy_settings(user_data).last_seen_visibility == 'nobody':
+                        user_data['is_online'] = False
+                        user_data['last_seen'] = None
+                        last_seen_formatted = ''
+                    elif user_data.get('is_online'):
                         last_seen_formatted = 'online'
                     else:
-                        last_seen_formatted = format_last_seen(user_data.get('last_seen'))
-                    
-                    # Get last message - simplified query without ordering to avoid index requirement
-                    messages_query = db.collection('messages').where('participants', 'array_contains', current_user['id'])
-                    messages = messages_query.stream()
-                    
-                    last_message = None
-                    latest_timestamp = None
+                        last_seen_formatted = format_last_seen(user_data.get('last_seen'))
                     
-                    for msg in messages:
-                        msg_data = msg.to_dict()
-                        # Check if this message is between current user and connection
-                        if ((msg_data.get('sender_id') == current_user['id'] and msg_data.get('receiver_id') == conn_id) or \
-                           (msg_data.get('sender_id') == conn_id and msg_data.get('receiver_id') == current_user['id'])):
-                            
-                            msg_timestamp = msg_data.get('timestamp')
-                            if msg_timestamp and (latest_timestamp is None or msg_timestamp > latest_timestamp):
-                                latest_timestamp = msg_timestamp
-                                last_message = {
-                                    "text": msg_data['message_text'],
-                                    "timestamp": msg_data['timestamp'],
-                                    "type": msg_data['message_type'],
-                                    "sender_id": msg_data['sender_id']
-                                }
+                    inbox_entry = inbox[conn_id]
                     
                     connected_users.append({
                         "id": user_data['id'],
@@ -723,7 +1969,8 @@ async def get_connections(current_user = Depends(get_current_user)):
                         "is_online": user_data.get('is_online', False),
                         "last_seen": user_data.get('last_seen'),
                         "last_seen_formatted": last_seen_formatted,
-                        "last_message": last_message
+                        "last_message": inbox_entry.get('last_message'),
+                        "unread_count": inbox_entry.get('unread_count', 0)
                     })
                 else:
                     print(f"Connection user {conn_id} not found - removing from connections")
@@ -732,7 +1979,9 @@ async def get_connections(current_user = Depends(get_current_user)):
                     current_connections = current_user.get('connections', [])
                     if conn_id in current_connections:
                         current_connections.remove(conn_id)
-                        current_user_ref.update({'connections': current_connections})
+                        await firebase_service.update(current_user_ref, {'connections': current_connections})
+                        auth_cache.invalidate_user(current_user['id'])
+                        connection_graph.invalidate(current_user['id'])
             except Exception as conn_error:
                 print(f"Error processing connection {conn_id}: {str(conn_error)}")
                 continue
@@ -759,7 +2008,11 @@ async def update_profile(profile_data: dict, current_user = Depends(get_current_
         update_data['profile_image_url'] = profile_data['profile_image_url']
     
     if update_data:
-        user_ref.update(update_data)
+        await firebase_service.update(user_ref, update_data)
+        if update_data.get('profile_image_url') != current_user.get('profile_image_url') and 'profile_image_url' in update_data:
+            await firebase_service.update_upload_refs(add=[update_data['profile_image_url']], remove=[current_user.get('profile_image_url')])
+        auth_cache.invalidate_user(current_user['id'])
+        await firebase_service.sync_directory_entry({**current_user, **update_data})
         
         # Emit profile update to all connected users
         await sio.emit('user_profile_updated', {
@@ -769,6 +2022,16 @@ async def update_profile(profile_data: dict, current_user = Depends(get_current_
     
     return {"message": "Profile updated successfully"}
 
+@app.put("/users/me/privacy")
+async def update_privacy_settings(settings: PrivacySettings, current_user = Depends(get_current_user)):
+    """Update privacy settings (public_discovery controls directory listing)"""
+    privacy_settings = settings.dict()
+    await firebase_service.update(db.collection('users').document(current_user['id']), {'privacy_settings': privacy_settings})
+    auth_cache.invalidate_user(current_user['id'])
+    connection_graph.invalidate(current_user['id'])
+    await firebase_service.sync_directory_entry({**current_user, 'privacy_settings': privacy_settings})
+    return {"message": "Privacy settings updated", "privacy_settings": privacy_settings}
+
 @app.get("/users")
 async def get_users(current_user = Depends(get_current_user)):
     """This endpoint is now deprecated - use /users/connections instead"""
@@ -783,7 +2046,7 @@ async def send_chat_request(request_data: dict, current_user = Depends(get_curre
     
     # Find user by invite code
     users_query = db.collection('users').where('invite_code', '==', invite_code).limit(1)
-    users = users_query.stream()
+    users = await firebase_service.stream(users_query)
     
     target_user = None
     for user_doc in users:
@@ -810,7 +2073,7 @@ async def send_chat_request(request_data: dict, current_user = Depends(get_curre
         "created_at": firestore.SERVER_TIMESTAMP
     }
     
-    doc_ref = db.collection('chat_requests').add(request_doc)
+    doc_ref = await firebase_service.add(db.collection('chat_requests'), request_doc)
     request_id = doc_ref[1].id
     
     # Emit to target user
@@ -825,28 +2088,26 @@ async def send_chat_request(request_data: dict, current_user = Depends(get_curre
 
 
 # Chat routes
+CHAT_PAGE_DEFAULT_LIMIT = 50
+CHAT_PAGE_MAX_LIMIT = 200
+
 @app.get("/chats/{user_id}")
-async def get_chats(user_id: str, current_user = Depends(get_current_user)):
-    # Use simple query without ordering to avoid index requirement
-    messages_query = db.collection('messages').where('participants', 'array_contains', current_user['id'])
-    messages = messages_query.stream()
+async def get_chats(user_id: str, limit: Optional[int] = None, before: Optional[str] = None,
+                    after: Optional[str] = None, current_user = Depends(get_current_user)):
+    # Without paging parameters keep returning the full history as a plain list
+    if limit is None and before is None and after is None:
+        return await firebase_service.get_messages(current_user['id'], user_id)
     
-    user_chats = []
-    for msg in messages:
-        msg_data = msg.to_dict()
-        if (msg_data.get('sender_id') == current_user['id'] and msg_data.get('receiver_id') == user_id) or \
-           (msg_data.get('sender_id') == user_id and msg_data.get('receiver_id') == current_user['id']):
-            msg_data['id'] = msg.id
-            user_chats.append(msg_data)
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
     
-    # Sort by timestamp in Python
-    user_chats.sort(key=lambda x: x.get('timestamp', datetime.min))
-    return user_chats
+    limit = max(1, min(limit or CHAT_PAGE_DEFAULT_LIMIT, CHAT_PAGE_MAX_LIMIT))
+    return await firebase_service.get_messages_page(current_user['id'], user_id, limit, before=before, after=after)
 
 @app.post("/chats/send")
 async def send_message(message_data: MessageSend, current_user = Depends(get_current_user)):
     # Check if users are connected
-    receiver_doc = db.collection('users').document(message_data.receiver_id).get()
+    receiver_doc = await firebase_service.get(db.collection('users').document(message_data.receiver_id))
     if not receiver_doc.exists:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -858,11 +2119,11 @@ async def send_message(message_data: MessageSend, current_user = Depends(get_cur
     reply_to_message = None
     if message_data.reply_to_id:
         reply_msg_ref = db.collection('messages').document(message_data.reply_to_id)
-        reply_msg_doc = reply_msg_ref.get()
+        reply_msg_doc = await firebase_service.get(reply_msg_ref)
         if reply_msg_doc.exists:
             reply_msg_data = reply_msg_doc.to_dict()
             # Get sender name for reply
-            sender_doc = db.collection('users').document(reply_msg_data['sender_id']).get()
+            sender_doc = await firebase_service.get(db.collection('users').document(reply_msg_data['sender_id']))
             sender_name = sender_doc.to_dict()['name'] if sender_doc.exists else 'Unknown'
             
             reply_to_message = {
@@ -880,7 +2141,9 @@ async def send_message(message_data: MessageSend, current_user = Depends(get_cur
         "status": "sent",
         "message_type": message_data.message_type,
         "file_url": message_data.file_url,
+        "file_variants": message_data.file_variants,
         "participants": [current_user['id'], message_data.receiver_id],
+        "conversation_id": get_conversation_id(current_user['id'], message_data.receiver_id),
         "starred_by": [],
         "forwarded": False,
         "reply_to_id": message_data.reply_to_id,
@@ -890,8 +2153,13 @@ async def send_message(message_data: MessageSend, current_user = Depends(get_cur
         "reactions": []
     }
     
-    doc_ref = db.collection('messages').add(message_doc)
-    message_id = doc_ref[1].id
+    # The message and its inbox, search and upload reference writes land together
+    message_ref = db.collection('messages').document()
+    message_id = message_ref.id
+    batch = db.batch()
+    batch.set(message_ref, message_doc)
+    firebase_service.stage_message_created(batch, message_id, message_doc)
+    await firebase_service.call(batch.commit)
     
     # Emit to socket with UTC timestamp
     current_timestamp = datetime.utcnow()
@@ -903,6 +2171,7 @@ async def send_message(message_data: MessageSend, current_user = Depends(get_cur
         "timestamp": current_timestamp.isoformat() + 'Z',
         "message_type": message_data.message_type,
         "file_url": message_data.file_url,
+        "file_variants": message_data.file_variants,
         "caption": message_data.caption,
         "reply_to_message": reply_to_message,
         "sender_name": current_user['name']
@@ -913,6 +2182,12 @@ async def send_message(message_data: MessageSend, current_user = Depends(get_cur
     
     return {"id": message_id, "message": "Message sent"}
 
+@app.post("/chats/{user_id}/read")
+async def mark_chat_read(user_id: str, current_user = Depends(get_current_user)):
+    """Reset the unread counter of a conversation in the caller's inbox"""
+    await firebase_service.mark_inbox_read(current_user['id'], user_id)
+    return {"message": "Chat marked as read"}
+
 # Message reactions
 @app.post("/messages/{message_id}/react")
 async def react_to_message(message_id: str, reaction: MessageReaction, current_user = Depends(get_current_user)):
@@ -925,7 +2200,7 @@ async def react_to_message(message_id: str, reaction: MessageReaction, current_u
         
         # Get the message to update reactions
         message_ref = db.collection('messages').document(message_id)
-        message_doc = message_ref.get()
+        message_doc = await firebase_service.get(message_ref)
         
         if not message_doc.exists:
             print(f"Message not found: {message_id}")
@@ -967,7 +2242,7 @@ async def react_to_message(message_id: str, reaction: MessageReaction, current_u
             print(f"Added new reaction: {new_reaction}")
         
         # Update message with new reactions
-        message_ref.update({'reactions': reactions})
+        await firebase_service.update(message_ref, {'reactions': reactions})
         print(f"Updated message reactions: {len(reactions)} total")
         
         # Emit reaction update to both users
@@ -995,14 +2270,15 @@ async def react_to_message(message_id: str, reaction: MessageReaction, current_u
 @app.put("/messages/{message_id}")
 async def edit_message(message_id: str, new_text: str, current_user = Depends(get_current_user)):
     message_ref = db.collection('messages').document(message_id)
-    message_doc = message_ref.get()
+    message_doc = await firebase_service.get(message_ref)
     
     if message_doc.exists and message_doc.to_dict().get('sender_id') == current_user['id']:
-        message_ref.update({
+        await firebase_service.update(message_ref, {
             'message_text': new_text,
             'edited': True,
             'edited_at': firestore.SERVER_TIMESTAMP
         })
+        await firebase_service.message_edited(message_id, message_conversation(message_doc.to_dict()), new_text)
         return {"message": "Message edited"}
     
     raise HTTPException(status_code=404, detail="Message not found or unauthorized")
@@ -1011,10 +2287,12 @@ async def edit_message(message_id: str, new_text: str, current_user = Depends(ge
 @app.delete("/messages/{message_id}")
 async def delete_message(message_id: str, current_user = Depends(get_current_user)):
     message_ref = db.collection('messages').document(message_id)
-    message_doc = message_ref.get()
+    message_doc = await firebase_service.get(message_ref)
     
     if message_doc.exists and message_doc.to_dict().get('sender_id') == current_user['id']:
-        message_ref.delete()
+        # The search and upload reference updates only land together with the delete
+        if not await firebase_service.message_deleted(message_doc, message_conversation(message_doc.to_dict())):
+            raise HTTPException(status_code=409, detail="Message changed while deleting; try again")
         return {"message": "Message deleted"}
     
     raise HTTPException(status_code=404, detail="Message not found or unauthorized")
@@ -1031,16 +2309,38 @@ async def create_status(status: StatusUpdate, current_user = Depends(get_current
         "expires_at": datetime.utcnow() + timedelta(hours=24),
         "views": []
     }
-    doc_ref = db.collection('statuses').add(new_status)
+    status_ref = db.collection('statuses').document()
+    batch = db.batch()
+    batch.set(status_ref, new_status)
+    firebase_service.stage_upload_refs(batch, [status.media_url], 1)
+    await firebase_service.call(batch.commit)
     
-    return {"id": doc_ref[1].id, "message": "Status created"}
+    return {"id": status_ref.id, "message": "Status created"}
+
+# The feed only reads statuses of the viewer and their connections, in chunks
+# of Firestore's `in` limit (uses the user_id+expires_at index)
+STATUS_FEED_IN_LIMIT = 30
+STATUS_SWEEP_INTERVAL = int(os.getenv("STATUS_SWEEP_INTERVAL", "600"))
 
 @app.get("/status")
 async def get_statuses(current_user = Depends(get_current_user)):
     # Get active statuses (not expired)
     now = datetime.utcnow()
-    statuses_query = db.collection('statuses').where('expires_at', '>', now)
-    statuses = statuses_query.stream()
+    author_ids = list(dict.fromkeys([current_user['id']] + current_user.get('connections', [])))
+    chunks = await asyncio.gather(*[
+        firebase_service.stream(
+            db.collection('statuses')
+            .where('user_id', 'in', author_ids[i:i + STATUS_FEED_IN_LIMIT])
+            .where('expires_at', '>', now)
+        )
+        for i in range(0, len(author_ids), STATUS_FEED_IN_LIMIT)
+    ])
+    statuses = sorted(
+        (status_doc for docs in chunks for status_doc in docs),
+        key=lambda status_doc: status_doc.to_dict().get('timestamp') or now.replace(tzinfo=pytz.utc)
+    )
+    
+    authors = await firebase_service.get_users_by_ids(status_doc.to_dict().get('user_id') for status_doc in statuses)
     
     # Group by user
     user_statuses = {}
@@ -1048,9 +2348,8 @@ async def get_statuses(current_user = Depends(get_current_user)):
         status_data = status_doc.to_dict()
         status_data['id'] = status_doc.id
         
-        user_doc = db.collection('users').document(status_data['user_id']).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
+        user_data = authors.get(status_data['user_id'])
+        if user_data:
             user_id = status_data['user_id']
             
             if user_id not in user_statuses:
@@ -1062,9 +2361,410 @@ async def get_statuses(current_user = Depends(get_current_user)):
     
     return list(user_statuses.values())
 
+async def sweep_expired_statuses():
+    """Batch-delete expired statuses and release their media references"""
+    # Only reference counts are touched: media_url is client-supplied, so files
+    # are never unlinked on its say-so; unreferenced uploads go via their sweeper
+    def release_media(batch, doc):
+        firebase_service.stage_upload_refs(batch, [doc.to_dict().get('media_url')], -1)
+    
+    while True:
+        await asyncio.sleep(STATUS_SWEEP_INTERVAL)
+        try:
+            expired = db.collection('statuses').where('expires_at', '<=', datetime.utcnow())
+            removed = await firebase_service.delete_query(expired, stage=release_media, ops_per_doc=2)
+            if removed:
+                print(f"Swept {removed} expired statuses")
+        except Exception as e:
+            print(f"Status sweep error: {e}")
+
+# ==================== UPLOADS ====================
+# Uploads are streamed to a temp file one chunk at a time and hashed as they
+# arrive, so a worker holds at most one chunk per upload in memory.
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Allowance for multipart boundaries and part headers in Content-Length
+UPLOAD_MULTIPART_OVERHEAD = 64 * 1024
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))
+UPLOAD_TMP_DIR = 'upload_tmp'
+os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+# Files are stored once as uploads/{sha256}{ext}; uploads/{sha256} in Firestore counts
+# the messages, statuses and profiles pointing at them. Unreferenced files are
+# swept once they have been idle for the grace period.
+UPLOAD_ORPHAN_GRACE = int(os.getenv("UPLOAD_ORPHAN_GRACE", str(24 * 3600)))
+UPLOAD_SWEEP_INTERVAL = int(os.getenv("UPLOAD_SWEEP_INTERVAL", "3600"))
+
+# ==================== STORAGE BACKENDS ====================
+# Stored media lives on local disk (uploads/) or in an S3-compatible bucket
+# (AWS S3, MinIO, R2...) that clients read and write directly through presigned
+# URLs. Object keys are the stored file names, and UPLOADS_URL stays the public
+# base: point it at the bucket/CDN, or keep it on this API, whose /uploads route
+# redirects to presigned GETs.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")  # local or s3
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # e.g. http://localhost:9000 for MinIO
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+PRESIGNED_URL_TTL = int(os.getenv("PRESIGNED_URL_TTL", "3600"))
+
+class LocalStorage:
+    remote = False
+
+    def __init__(self, directory: str = 'uploads'):
+        self.directory = directory
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    async def put_file(self, source_path: str, key: str, content_type: Optional[str] = None):
+        """Move a finished temp file into the store"""
+        os.replace(source_path, self.path(key))
+
+    async def object_size(self, key: str) -> Optional[int]:
+        try:
+            return os.path.getsize(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    async def verify_digest(self, key: str, digest: str) -> bool:
+        return await asyncio.get_running_loop().run_in_executor(None, hash_file, self.path(key)) == digest
+
+    async def download(self, key: str, target_path: str):
+        await asyncio.get_running_loop().run_in_executor(None, shutil.copyfile, self.path(key), target_path)
+
+    async def delete(self, key: str):
+        remove_quietly(self.path(key))
+
+    async def presign_put(self, key: str, content_type: Optional[str], size: int, digest: str) -> Optional[dict]:
+        return None
+
+    async def presign_get(self, key: str) -> Optional[str]:
+        return None
+
+class S3Storage:
+    remote = True
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None, region: Optional[str] = None):
+        import boto3
+        from botocore.config import Config
+        self.bucket = bucket
+        # Credentials come from the usual AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY chain
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region, config=Config(
+            signature_version='s3v4',
+            s3={'addressing_style': 'path' if endpoint_url else 'auto'}
+        ))
+
+    async def run(self, func, *args, **kwargs):
+        """boto3 is blocking, so requests go through the default thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    async def put_file(self, source_path: str, key: str, content_type: Optional[str] = None):
+        extra_args = {'CacheControl': IMMUTABLE_CACHE_CONTROL}
+        if content_type:
+            extra_args['ContentType'] = content_type
+        await self.run(self.client.upload_file, source_path, self.bucket, key, ExtraArgs=extra_args)
+        remove_quietly(source_path)
+
+    async def head(self, key: str, **kwargs) -> Optional[dict]:
+        from botocore.exceptions import ClientError
+        try:
+            return await self.run(self.client.head_object, Bucket=self.bucket, Key=key, **kwargs)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    async def object_size(self, key: str) -> Optional[int]:
+        head = await self.head(key)
+        return head['ContentLength'] if head else None
+
+    async def verify_digest(self, key: str, digest: str) -> bool:
+        """Trust the SHA-256 checksum the bucket verified on PUT; stores that keep none get the object hashed"""
+        head = await self.head(key, ChecksumMode='ENABLED')
+        if not head:
+            return False
+        if head.get('ChecksumSHA256'):
+            return head['ChecksumSHA256'] == base64.b64encode(bytes.fromhex(digest)).decode()
+        return await self.run(self.hash_object, key) == digest
+
+    def hash_object(self, key: str) -> str:
+        hasher = hashlib.sha256()
+        body = self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+        for chunk in body.iter_chunks(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+    async def download(self, key: str, target_path: str):
+        await self.run(self.client.download_file, self.bucket, key, target_path)
+
+    async def delete(self, key: str):
+        await self.run(self.client.delete_object, Bucket=self.bucket, Key=key)
+
+    async def presign_put(self, key: str, content_type: Optional[str], size: int, digest: str) -> Optional[dict]:
+        """PUT URL bound to the declared length and SHA-256, so the bucket rejects anything else"""
+        checksum = base64.b64encode(bytes.fromhex(digest)).decode()
+        params = {
+            'Bucket': self.bucket,
+            'Key': key,
+            'ContentLength': size,
+            'ChecksumSHA256': checksum,
+            'CacheControl': IMMUTABLE_CACHE_CONTROL
+        }
+        headers = {'x-amz-checksum-sha256': checksum, 'Cache-Control': IMMUTABLE_CACHE_CONTROL}
+        if content_type:
+            params['ContentType'] = content_type
+            headers['Content-Type'] = content_type
+        url = self.client.generate_presigned_url('put_object', Params=params, ExpiresIn=PRESIGNED_URL_TTL)
+        return {'upload_url': url, 'method': 'PUT', 'headers': headers}
+
+    async def presign_get(self, key: str) -> Optional[str]:
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': key}, ExpiresIn=PRESIGNED_URL_TTL
+        )
+
+if STORAGE_BACKEND == 's3' and not S3_BUCKET:
+    raise RuntimeError("S3_BUCKET must be set when STORAGE_BACKEND=s3")
+storage = S3Storage(S3_BUCKET, S3_ENDPOINT_URL, S3_REGION) if STORAGE_BACKEND == 's3' else LocalStorage()
+
+# ==================== MEDIA PROCESSING ====================
+# Pillow work runs in worker processes so it neither blocks the loop nor holds the GIL
+MEDIA_PROCESS_WORKERS = int(os.getenv("MEDIA_PROCESS_WORKERS", "2"))
+MEDIA_PROCESS_TIMEOUT = float(os.getenv("MEDIA_PROCESS_TIMEOUT", "60"))
+MEDIA_IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'webp', 'gif'}
+
+class MediaPipeline:
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.executor = None
+
+    async def image_variants(self, file_path: str, stored_name: str) -> dict:
+        """Display and thumbnail URLs for an uploaded image, {} if it could not be processed"""
+        stem, extension = os.path.splitext(stored_name)
+        if extension.lstrip('.').lower() not in MEDIA_IMAGE_EXTENSIONS:
+            return {}
+        # Created on first use so worker processes are not forked at import time
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        
+        loop = asyncio.get_running_loop()
+        outputs = {}
+        try:
+            outputs = await asyncio.wait_for(
+                loop.run_in_executor(self.executor, FileUtils.create_variants, file_path, os.path.join(UPLOAD_TMP_DIR, stem)),
+                MEDIA_PROCESS_TIMEOUT
+            )
+            variants = {}
+            for name, path in outputs.items():
+                await storage.put_file(path, os.path.basename(path), 'image/jpeg')
+                variants[name] = f"{UPLOADS_URL}/{os.path.basename(path)}"
+            return variants
+        except BrokenProcessPool:
+            print("Media worker pool crashed, restarting it")
+            self.executor = None
+            return {}
+        except Exception as e:
+            print(f"Image processing failed for {stored_name}: {e}")
+            return {}
+        finally:
+            for path in outputs.values():
+                remove_quietly(path)
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+media_pipeline = MediaPipeline(MEDIA_PROCESS_WORKERS)
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    size: int
+    content_type: Optional[str] = None
+
+class PresignedUpload(BaseModel):
+    filename: str
+    size: int
+    sha256: str
+    content_type: Optional[str] = None
+
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    """Refuse oversized uploads from Content-Length before any of the body is read"""
+    if request.method in ("POST", "PUT") and request.url.path.startswith("/upload"):
+        length = request.headers.get("content-length", "")
+        # The multipart form is spooled in full before upload_file runs, so a chunked
+        # body there could not be held to the limit (session PUTs stream with one)
+        if request.method == "POST" and request.url.path == "/upload" and not length.isdigit():
+            return JSONResponse(status_code=411, content={"detail": "Content-Length required"})
+        if length.isdigit() and int(length) > UPLOAD_MAX_BYTES + UPLOAD_MULTIPART_OVERHEAD:
+            return JSONResponse(status_code=413, content={"detail": f"File exceeds the {UPLOAD_MAX_BYTES} byte limit"})
+    return await call_next(request)
+
+def upload_key(url: Optional[str]) -> Optional[str]:
+    """Storage key of a URL served by this app, None for anything else"""
+    prefix = next((prefix for prefix in UPLOADS_URL_PREFIXES if url and url.startswith(f"{prefix}/")), None)
+    if not prefix:
+        return None
+    name = url[len(prefix) + 1:]
+    if not name or '/' in name or name.startswith('.'):
+        return None
+    return name
+
+def stored_upload_digest(name: str) -> Optional[str]:
+    """SHA-256 in a content-addressed file name (original or variant)"""
+    match = re.fullmatch(r'([0-9a-f]{64})(?:_[a-z_]+)?(?:\.[a-z0-9]+)?', name)
+    return match.group(1) if match else None
+
+def upload_digest(url: Optional[str]) -> Optional[str]:
+    key = upload_key(url)
+    return stored_upload_digest(key) if key else None
+
+def upload_extension(filename: str) -> str:
+    extension = os.path.splitext(filename)[1].lower()
+    return extension if re.fullmatch(r'\.[a-z0-9]{1,10}', extension) else ''
+
+def upload_file_type(filename: str) -> str:
+    file_extension = filename.split('.')[-1].lower() if '.' in filename else ''
+    if file_extension in ['jpg', 'jpeg', 'png', 'gif', 'webp', 'svg']:
+        return 'image'
+    elif file_extension in ['mp4', 'avi', 'mov', 'wmv', 'flv', 'webm']:
+        return 'video'
+    elif file_extension in ['mp3', 'wav', 'ogg', 'm4a', 'aac']:
+        return 'audio'
+    return 'file'
+
+async def upload_chunks(file: UploadFile):
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+async def stream_to_file(chunks, path: str, limit: int, mode: str = 'wb', start: int = 0, hasher=None) -> int:
+    """Write an async stream of byte chunks to path at start without exceeding limit; returns the new size"""
+    size = start
+    async with aiofiles.open(path, mode) as f:
+        if start:
+            await f.seek(start)
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > limit:
+                raise HTTPException(status_code=413, detail=f"Upload exceeds {limit} bytes")
+            if hasher:
+                hasher.update(chunk)
+            await f.write(chunk)
+        # Anything past the written range belongs to a superseded write
+        await f.truncate()
+    return size
+
+def hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+async def stored_upload(digest: str, reuse: bool = False) -> tuple:
+    """(doc ref, record) for a digest; the record is {} unless the stored object still exists.
+
+    reuse=True restarts the orphan grace period of a stored copy. That touch is
+    conditioned on the update time read, so a record the sweeper deleted (or
+    anyone changed) in between is read again instead of being handed out.
+    """
+    upload_ref = db.collection('uploads').document(digest)
+    while True:
+        upload_doc = await firebase_service.get(upload_ref)
+        record = upload_doc.to_dict() if upload_doc.exists else {}
+        if not record.get('stored_name') or await storage.object_size(record['stored_name']) is None:
+            return upload_ref, {'ref_count': record['ref_count']} if 'ref_count' in record else {}
+        if not reuse:
+            return upload_ref, record
+        try:
+            await firebase_service.call(
+                upload_ref.update, {'updated_at': firestore.SERVER_TIMESTAMP},
+                option=db.write_option(last_update_time=upload_doc.update_time)
+            )
+            return upload_ref, record
+        except (FailedPrecondition, NotFound):
+            continue
+
+async def record_upload(upload_ref, existing: dict, stored_name: str, size: int, file_type: str, variants: dict):
+    upload_record = {
+        'stored_name': stored_name,
+        'size': size,
+        'file_type': file_type,
+        'variants': variants,
+        'created_at': firestore.SERVER_TIMESTAMP,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    }
+    if 'ref_count' not in existing:
+        upload_record['ref_count'] = 0
+    await firebase_service.set(upload_ref, upload_record, merge=True)
+
+def describe_upload(stored_name: str, filename: str, size: int, digest: str, variants: dict, deduplicated: bool) -> dict:
+    file_type = upload_file_type(filename)
+    result = {
+        "file_url": f"{UPLOADS_URL}/{stored_name}",
+        "filename": filename,
+        "file_type": file_type,
+        "size": size,
+        "sha256": digest,
+        "deduplicated": deduplicated
+    }
+    if file_type == 'image':
+        result['variants'] = variants
+    return result
+
+async def finalize_upload(temp_path: str, filename: str, size: int, digest: str) -> dict:
+    """Store a fully received temp file under its digest, reusing an identical stored copy"""
+    upload_ref, existing = await stored_upload(digest, reuse=True)
+    if existing.get('stored_name'):
+        remove_quietly(temp_path)
+        return describe_upload(existing['stored_name'], filename, size, digest, existing.get('variants') or {}, True)
+    
+    file_type = upload_file_type(filename)
+    stored_name = f"{digest}{upload_extension(filename)}"
+    variants = await media_pipeline.image_variants(temp_path, stored_name) if file_type == 'image' else {}
+    await storage.put_file(temp_path, stored_name, mimetypes.guess_type(filename)[0])
+    await record_upload(upload_ref, existing, stored_name, size, file_type, variants)
+    return describe_upload(stored_name, filename, size, digest, variants, False)
+
+async def sweep_unreferenced_uploads():
+    """Delete stored files no message, status or profile has pointed at for UPLOAD_ORPHAN_GRACE"""
+    while True:
+        await asyncio.sleep(UPLOAD_SWEEP_INTERVAL)
+        try:
+            cutoff = datetime.now(pytz.utc) - timedelta(seconds=UPLOAD_ORPHAN_GRACE)
+            query = db.collection('uploads').where('ref_count', '==', 0).where('updated_at', '<', cutoff)
+            
+            # Objects go after their records, and only for pages that committed, so a
+            # failure strands files rather than records
+            async def delete_objects(docs):
+                for doc in docs:
+                    # A record written since the commit means the same content is being stored again
+                    if (await firebase_service.get(doc.reference)).exists:
+                        continue
+                    upload = doc.to_dict()
+                    keys = list(filter(None, map(upload_key, (upload.get('variants') or {}).values())))
+                    if upload.get('stored_name'):
+                        keys.append(upload['stored_name'])
+                    for key in keys:
+                        await storage.delete(key)
+            
+            removed = await firebase_service.delete_query(query, on_commit=delete_objects)
+            if removed:
+                print(f"Swept {removed} unreferenced uploads")
+        except Exception as e:
+            print(f"Upload sweep error: {e}")
+
 # File upload
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...), current_user = Depends(get_current_user)):
+    temp_path = os.path.join(UPLOAD_TMP_DIR, uuid.uuid4().hex)
     try:
         print(f"Upload request from user: {current_user['id']}")
         print(f"File: {file.filename}, Content-Type: {file.content_type}")
@@ -1072,43 +2772,273 @@ async def upload_file(file: UploadFile = File(...), current_user = Depends(get_c
         if not file.filename:
             raise HTTPException(status_code=400, detail="No file provided")
         
-        content = await file.read()
-        if len(content) == 0:
+        hasher = hashlib.sha256()
+        size = await stream_to_file(upload_chunks(file), temp_path, UPLOAD_MAX_BYTES, hasher=hasher)
+        if size == 0:
             raise HTTPException(status_code=400, detail="Empty file")
         
-        # Generate unique filename
-        timestamp = datetime.utcnow().timestamp()
-        filename = f"{timestamp}_{file.filename}"
-        filepath = f"uploads/{filename}"
-        
-        # Save file locally
-        async with aiofiles.open(filepath, 'wb') as f:
-            await f.write(content)
-        
-        # Return production file URL
-        file_url = f"https://widechat.onrender.com/uploads/{filename}"
-        
-        # Determine file type
-        file_extension = file.filename.split('.')[-1].lower() if '.' in file.filename else ''
-        if file_extension in ['jpg', 'jpeg', 'png', 'gif', 'webp', 'svg']:
-            file_type = 'image'
-        elif file_extension in ['mp4', 'avi', 'mov', 'wmv', 'flv', 'webm']:
-            file_type = 'video'
-        elif file_extension in ['mp3', 'wav', 'ogg', 'm4a', 'aac']:
-            file_type = 'audio'
-        else:
-            file_type = 'file'
-        
-        return {
-            "file_url": file_url,
-            "filename": file.filename,
-            "file_type": file_type
-        }
+        return await finalize_upload(temp_path, file.filename, size, hasher.hexdigest())
     except HTTPException:
         raise
     except Exception as e:
         print(f"Upload error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
+    finally:
+        remove_quietly(temp_path)
+
+# Resumable uploads: create a session, PUT byte ranges at the current offset,
+# and the file is finalized once the declared size has been received.
+def upload_session_path(session_id: str) -> str:
+    return os.path.join(UPLOAD_TMP_DIR, f"session_{session_id}")
+
+def upload_session_offset(session_id: str) -> int:
+    path = upload_session_path(session_id)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+# One writer per session at a time; a lock lives only while a request holds it
+upload_session_locks = weakref.WeakValueDictionary()
+
+def upload_session_lock(session_id: str) -> asyncio.Lock:
+    lock = upload_session_locks.get(session_id)
+    if lock is None:
+        lock = upload_session_locks[session_id] = asyncio.Lock()
+    return lock
+
+async def get_upload_session(session_id: str, user_id: str) -> dict:
+    session_doc = await firebase_service.get(db.collection('upload_sessions').document(session_id))
+    if not session_doc.exists or session_doc.to_dict().get('owner_id') != user_id:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    session = session_doc.to_dict()
+    if session['status'] == 'open' and session['expires_at'] < datetime.now(pytz.utc):
+        remove_quietly(upload_session_path(session_id))
+        raise HTTPException(status_code=410, detail="Upload session expired")
+    return session
+
+@app.post("/upload/sessions")
+async def create_upload_session(session_data: UploadSessionCreate, current_user = Depends(get_current_user)):
+    if session_data.size <= 0:
+        raise HTTPException(status_code=400, detail="Empty file")
+    if session_data.size > UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"File exceeds the {UPLOAD_MAX_BYTES} byte limit")
+    
+    session_ref = db.collection('upload_sessions').document()
+    await firebase_service.set(session_ref, {
+        "owner_id": current_user['id'],
+        "filename": session_data.filename,
+        "content_type": session_data.content_type,
+        "size": session_data.size,
+        "status": "open",
+        "created_at": firestore.SERVER_TIMESTAMP,
+        "expires_at": datetime.now(pytz.utc) + timedelta(seconds=UPLOAD_SESSION_TTL)
+    })
+    return {"session_id": session_ref.id, "offset": 0, "chunk_size": UPLOAD_CHUNK_SIZE}
+
+@app.get("/upload/sessions/{session_id}")
+async def get_upload_session_status(session_id: str, current_user = Depends(get_current_user)):
+    """Where a client should resume from after a dropped connection"""
+    session = await get_upload_session(session_id, current_user['id'])
+    if session['status'] == 'complete':
+        return {"session_id": session_id, "offset": session['size'], "complete": True, **session['result']}
+    return {"session_id": session_id, "offset": upload_session_offset(session_id), "size": session['size'], "complete": False}
+
+@app.put("/upload/sessions/{session_id}")
+async def upload_session_chunk(session_id: str, offset: int, request: Request, current_user = Depends(get_current_user)):
+    """Write the request body at offset, which must match the bytes already received"""
+    async with upload_session_lock(session_id):
+        # Read under the lock: a request that waited may find the session already finished
+        session = await get_upload_session(session_id, current_user['id'])
+        if session['status'] == 'complete':
+            return {"session_id": session_id, "offset": session['size'], "complete": True, **session['result']}
+        
+        current_offset = upload_session_offset(session_id)
+        if offset != current_offset:
+            raise HTTPException(status_code=409, detail=f"Expected offset {current_offset}")
+        
+        # Written at the offset rather than appended, so a retried chunk cannot duplicate bytes
+        path = upload_session_path(session_id)
+        mode = 'r+b' if os.path.exists(path) else 'wb'
+        new_offset = await stream_to_file(request.stream(), path, session['size'], mode=mode, start=current_offset)
+        if new_offset < session['size']:
+            return {"session_id": session_id, "offset": new_offset, "size": session['size'], "complete": False}
+        
+        received = upload_session_offset(session_id)
+        if received != session['size']:
+            raise HTTPException(status_code=409, detail=f"Expected offset {received}")
+        
+        # Chunks arrive over several requests, so the digest is taken once, off the loop
+        digest = await asyncio.get_running_loop().run_in_executor(None, hash_file, path)
+        result = await finalize_upload(path, session['filename'], received, digest)
+        await firebase_service.update(db.collection('upload_sessions').document(session_id), {
+            "status": "complete",
+            "result": result,
+            "completed_at": firestore.SERVER_TIMESTAMP
+        })
+        remove_quietly(path)
+        return {"session_id": session_id, "offset": received, "complete": True, **result}
+
+async def sweep_expired_upload_sessions():
+    """Delete open upload sessions past their TTL together with their partial files"""
+    while True:
+        await asyncio.sleep(UPLOAD_SWEEP_INTERVAL)
+        try:
+            expired = db.collection('upload_sessions').where('status', '==', 'open').where('expires_at', '<', datetime.now(pytz.utc))
+            def remove_partial_file(batch, doc):
+                remove_quietly(upload_session_path(doc.id))
+            
+            removed = await firebase_service.delete_query(expired, stage=remove_partial_file)
+            
+            # Partial files whose session record is already gone; a live session
+            # is never older than its TTL, so its file is never touched here
+            cutoff = time.time() - UPLOAD_SESSION_TTL
+            for entry in os.scandir(UPLOAD_TMP_DIR):
+                if entry.name.startswith('session_') and entry.stat().st_mtime < cutoff:
+                    remove_quietly(entry.path)
+            if removed:
+                print(f"Swept {removed} expired upload sessions")
+        except Exception as e:
+            print(f"Upload session sweep error: {e}")
+
+# Direct uploads: the client PUTs straight to object storage under the content
+# hash it declared, then confirms; the API only handles the metadata.
+@app.post("/upload/presign")
+async def presign_upload(upload_data: PresignedUpload, current_user = Depends(get_current_user)):
+    digest = upload_data.sha256.lower()
+    if not re.fullmatch(r'[0-9a-f]{64}', digest):
+        raise HTTPException(status_code=400, detail="sha256 must be a hex digest")
+    if upload_data.size <= 0:
+        raise HTTPException(status_code=400, detail="Empty file")
+    if upload_data.size > UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"File exceeds the {UPLOAD_MAX_BYTES} byte limit")
+    
+    upload_ref, existing = await stored_upload(digest, reuse=True)
+    if existing.get('stored_name'):
+        return {"complete": True, **describe_upload(
+            existing['stored_name'], upload_data.filename, upload_data.size, digest, existing.get('variants') or {}, True
+        )}
+    
+    key = f"{digest}{upload_extension(upload_data.filename)}"
+    content_type = upload_data.content_type or mimetypes.guess_type(upload_data.filename)[0]
+    presigned = await storage.presign_put(key, content_type, upload_data.size, digest)
+    if not presigned:
+        raise HTTPException(status_code=400, detail="Direct uploads need object storage; use /upload")
+    return {"complete": False, "key": key, "expires_in": PRESIGNED_URL_TTL, **presigned}
+
+@app.post("/upload/presign/complete")
+async def complete_presigned_upload(upload_data: PresignedUpload, current_user = Depends(get_current_user)):
+    """Register an object the client uploaded directly, after checking it against its declaration"""
+    digest = upload_data.sha256.lower()
+    if not re.fullmatch(r'[0-9a-f]{64}', digest):
+        raise HTTPException(status_code=400, detail="sha256 must be a hex digest")
+    upload_ref, existing = await stored_upload(digest)
+    if existing.get('stored_name'):
+        return describe_upload(existing['stored_name'], upload_data.filename, upload_data.size, digest, existing.get('variants') or {}, True)
+    
+    key = f"{digest}{upload_extension(upload_data.filename)}"
+    size = await storage.object_size(key)
+    if size is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    if size != upload_data.size or not await storage.verify_digest(key, digest):
+        await storage.delete(key)
+        raise HTTPException(status_code=400, detail="Uploaded object does not match its declared size and sha256")
+    
+    file_type = upload_file_type(upload_data.filename)
+    variants = {}
+    if file_type == 'image':
+        # Variants need the pixels, so images make one trip through the worker
+        temp_path = os.path.join(UPLOAD_TMP_DIR, uuid.uuid4().hex)
+        try:
+            await storage.download(key, temp_path)
+            variants = await media_pipeline.image_variants(temp_path, key)
+        finally:
+            remove_quietly(temp_path)
+    await record_upload(upload_ref, existing, key, size, file_type, variants)
+    return describe_upload(key, upload_data.filename, size, digest, variants, False)
+
+# ==================== MEDIA SERVING ====================
+# Content-addressed files never change, so they are cacheable forever; other
+# (legacy) files get a bounded max-age and are revalidated through their ETag.
+UPLOADS_CACHE_MAX_AGE = int(os.getenv("UPLOADS_CACHE_MAX_AGE", "86400"))
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MEDIA_RANGE_CHUNK = 256 * 1024
+
+def parse_byte_range(header: str, size: int) -> Optional[tuple]:
+    """Inclusive (start, end) of a single bytes range; None means serve the whole file"""
+    units, _, spec = header.partition('=')
+    # Multi-range requests may be answered with the full representation
+    if units.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    start_text, _, end_text = spec.strip().partition('-')
+    try:
+        if start_text:
+            start = int(start_text)
+            end = min(int(end_text), size - 1) if end_text else size - 1
+        else:
+            start, end = max(0, size - int(end_text)), size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Weak comparison, as If-None-Match requires"""
+    if header.strip() == '*':
+        return True
+    return any(candidate.strip().removeprefix('W/') == etag for candidate in header.split(','))
+
+async def read_file_range(path: str, start: int, end: int):
+    async with aiofiles.open(path, 'rb') as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(MEDIA_RANGE_CHUNK, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+@app.api_route("/uploads/{name}", methods=["GET", "HEAD"])
+async def serve_upload(name: str, request: Request):
+    """Stored media with strong ETags, long-lived caching and byte-range support"""
+    path = os.path.join('uploads', name)
+    if name.startswith('.'):
+        raise HTTPException(status_code=404, detail="File not found")
+    if not os.path.isfile(path):
+        # Objects in a private bucket are handed out as short-lived presigned URLs
+        if storage.remote:
+            return RedirectResponse(await storage.presign_get(name), status_code=307, headers={
+                "Cache-Control": f"private, max-age={PRESIGNED_URL_TTL // 2}"
+            })
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    stat_result = os.stat(path)
+    immutable = stored_upload_digest(name) is not None
+    etag = f'"{os.path.splitext(name)[0]}"' if immutable else f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else f"public, max-age={UPLOADS_CACHE_MAX_AGE}",
+        "Accept-Ranges": "bytes"
+    }
+    media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    byte_range = parse_byte_range(range_header, stat_result.st_size) if range_header and (not if_range or if_range == etag) else None
+    if byte_range:
+        start, end = byte_range
+        headers.update({
+            "Content-Range": f"bytes {start}-{end}/{stat_result.st_size}",
+            "Content-Length": str(end - start + 1)
+        })
+        if request.method == "HEAD":
+            return Response(status_code=206, headers=headers, media_type=media_type)
+        return StreamingResponse(read_file_range(path, start, end), status_code=206, headers=headers, media_type=media_type)
+    
+    return FileResponse(path, headers=headers, media_type=media_type, stat_result=stat_result)
 
 # Call routes
 @app.post("/calls/initiate")
@@ -1116,7 +3046,7 @@ async def initiate_call(call_data: dict, current_user = Depends(get_current_user
     receiver_id = call_data.get('receiver_id')
     
     # Get receiver details
-    receiver_doc = db.collection('users').document(receiver_id).get()
+    receiver_doc = await firebase_service.get(db.collection('users').document(receiver_id))
     if not receiver_doc.exists:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -1135,7 +3065,7 @@ async def initiate_call(call_data: dict, current_user = Depends(get_current_user
         "started_at": firestore.SERVER_TIMESTAMP,
         "participants": [current_user['id'], receiver_id]
     }
-    doc_ref = db.collection('calls').add(call_db)
+    doc_ref = await firebase_service.add(db.collection('calls'), call_db)
     call_id = doc_ref[1].id
     
     # Create serializable call object for socket emission
@@ -1162,7 +3092,7 @@ async def respond_to_call(response_data: dict, current_user = Depends(get_curren
     action = response_data.get('action')
     
     call_ref = db.collection('calls').document(call_id)
-    call_doc = call_ref.get()
+    call_doc = await firebase_service.get(call_ref)
     
     if call_doc.exists:
         call_data = call_doc.to_dict()
@@ -1173,7 +3103,7 @@ async def respond_to_call(response_data: dict, current_user = Depends(get_curren
         elif action == 'end':
             update_data['ended_at'] = firestore.SERVER_TIMESTAMP
         
-        call_ref.update(update_data)
+        await firebase_service.update(call_ref, update_data)
         
         # Emit response to caller
         target_user = call_data['caller_id'] if call_data['receiver_id'] == current_user['id'] else call_data['receiver_id']
@@ -1188,7 +3118,7 @@ async def respond_to_call(response_data: dict, current_user = Depends(get_curren
 async def get_call_history(current_user = Depends(get_current_user)):
     # Use simple query without ordering to avoid index requirement
     calls_query = db.collection('calls').where('participants', 'array_contains', current_user['id'])
-    calls = calls_query.stream()
+    calls = await firebase_service.stream(calls_query)
     
     user_calls = []
     for call_doc in calls:
@@ -1205,7 +3135,7 @@ async def get_call_history(current_user = Depends(get_current_user)):
 async def pin_chat(chat_id: str, current_user = Depends(get_current_user)):
     # Check if already pinned
     pinned_query = db.collection('pinned_chats').where('user_id', '==', current_user['id']).where('chat_id', '==', chat_id)
-    existing = list(pinned_query.stream())
+    existing = await firebase_service.stream(pinned_query)
     
     if not existing:
         pinned_chat = {
@@ -1213,23 +3143,23 @@ async def pin_chat(chat_id: str, current_user = Depends(get_current_user)):
             "chat_id": chat_id,
             "pinned_at": firestore.SERVER_TIMESTAMP
         }
-        db.collection('pinned_chats').add(pinned_chat)
+        await firebase_service.add(db.collection('pinned_chats'), pinned_chat)
     
     return {"message": "Chat pinned"}
 
 @app.delete("/chats/{chat_id}/pin")
 async def unpin_chat(chat_id: str, current_user = Depends(get_current_user)):
     pinned_query = db.collection('pinned_chats').where('user_id', '==', current_user['id']).where('chat_id', '==', chat_id)
-    docs = pinned_query.stream()
+    docs = await firebase_service.stream(pinned_query)
     for doc in docs:
-        doc.reference.delete()
+        await firebase_service.delete(doc.reference)
     return {"message": "Chat unpinned"}
 
 @app.post("/chats/{chat_id}/archive")
 async def archive_chat(chat_id: str, current_user = Depends(get_current_user)):
     # Check if already archived
     archived_query = db.collection('archived_chats').where('user_id', '==', current_user['id']).where('chat_id', '==', chat_id)
-    existing = list(archived_query.stream())
+    existing = await firebase_service.stream(archived_query)
     
     if not existing:
         archived_chat = {
@@ -1237,37 +3167,64 @@ async def archive_chat(chat_id: str, current_user = Depends(get_current_user)):
             "chat_id": chat_id,
             "archived_at": firestore.SERVER_TIMESTAMP
         }
-        db.collection('archived_chats').add(archived_chat)
+        await firebase_service.add(db.collection('archived_chats'), archived_chat)
     
     return {"message": "Chat archived"}
 
 @app.delete("/chats/{chat_id}/archive")
 async def unarchive_chat(chat_id: str, current_user = Depends(get_current_user)):
     archived_query = db.collection('archived_chats').where('user_id', '==', current_user['id']).where('chat_id', '==', chat_id)
-    docs = archived_query.stream()
+    docs = await firebase_service.stream(archived_query)
     for doc in docs:
-        doc.reference.delete()
+        await firebase_service.delete(doc.reference)
     return {"message": "Chat unarchived"}
 
 @app.delete("/chats/{chat_id}/clear")
-async def clear_chat_history(chat_id: str, current_user = Depends(get_current_user)):
-    # Delete messages between current user and chat_id - use simple query
-    messages_query = db.collection('messages').where('participants', 'array_contains', current_user['id'])
-    messages = messages_query.stream()
+async def clear_chat_history(chat_id: str, for_everyone: bool = True, current_user = Depends(get_current_user)):
+    """Clear a chat for both sides (background bulk delete) or only for the caller (watermark)"""
+    user_id = current_user['id']
     
-    for msg_doc in messages:
-        msg_data = msg_doc.to_dict()
-        if (msg_data.get('sender_id') == current_user['id'] and msg_data.get('receiver_id') == chat_id) or \
-           (msg_data.get('sender_id') == chat_id and msg_data.get('receiver_id') == current_user['id']):
-            msg_doc.reference.delete()
+    if not for_everyone:
+        # O(1) for the caller's view; their own search entries are purged in the background
+        await firebase_service.clear_conversation_for(user_id, chat_id)
+        await sio.emit("chat_cleared", {"chat_id": chat_id, "for_everyone": False}, room=f"user_{user_id}")
+        job_id = await jobs.start('clear_chat', user_id, run_clear_chat_job, chat_id=chat_id, for_everyone=False)
+        return {"message": "Chat history cleared", "job_id": job_id}
+    
+    job_id = await jobs.start('clear_chat', user_id, run_clear_chat_job, chat_id=chat_id, for_everyone=True)
+    return {"message": "Clearing chat history", "job_id": job_id}
+
+async def run_clear_chat_job(job: JobContext) -> dict:
+    """Everything a clear_chat job needs is in its document, so a resumed job reruns from there"""
+    user_id, peer_id = job.data['owner_id'], job.data['chat_id']
+    conversation_id = get_conversation_id(user_id, peer_id)
+    if job.data.get('for_everyone'):
+        return await run_clear_chat(job, conversation_id, user_id, peer_id)
+    # The caller's view is already cleared; only their own search entries remain
+    return {'processed': await firebase_service.unindex_conversation(conversation_id, user_id=user_id)}
+
+async def run_clear_chat(job: JobContext, conversation_id: str, user_id: str, peer_id: str) -> dict:
+    """Delete a conversation page by page, reporting progress to the user who asked"""
+    async def report(deleted: int):
+        await asyncio.gather(
+            job.update(processed=deleted),
+            sio.emit("chat_clear_progress", {"chat_id": peer_id, "job_id": job.id, "deleted": deleted}, room=f"user_{user_id}")
+        )
+    
+    deleted = await firebase_service.delete_messages(firebase_service.conversation_messages(conversation_id), on_progress=report)
+    await firebase_service.conversation_cleared(conversation_id, [user_id, peer_id])
     
-    return {"message": "Chat history cleared"}
+    await asyncio.gather(
+        sio.emit("chat_cleared", {"chat_id": peer_id, "job_id": job.id, "deleted": deleted, "for_everyone": True}, room=f"user_{user_id}"),
+        sio.emit("chat_cleared", {"chat_id": user_id, "for_everyone": True}, room=f"user_{peer_id}")
+    )
+    return {'processed': deleted}
 
 # ==================== MESSAGE FEATURES ====================
 @app.post("/messages/{message_id}/star")
 async def star_message(message_id: str, current_user = Depends(get_current_user)):
     message_ref = db.collection('messages').document(message_id)
-    message_doc = message_ref.get()
+    message_doc = await firebase_service.get(message_ref)
     
     if message_doc.exists:
         message_data = message_doc.to_dict()
@@ -1275,14 +3232,14 @@ async def star_message(message_id: str, current_user = Depends(get_current_user)
         
         if current_user['id'] not in starred_by:
             starred_by.append(current_user['id'])
-            message_ref.update({'starred_by': starred_by})
+            await firebase_service.update(message_ref, {'starred_by': starred_by})
     
     return {"message": "Message starred"}
 
 @app.delete("/messages/{message_id}/star")
 async def unstar_message(message_id: str, current_user = Depends(get_current_user)):
     message_ref = db.collection('messages').document(message_id)
-    message_doc = message_ref.get()
+    message_doc = await firebase_service.get(message_ref)
     
     if message_doc.exists:
         message_data = message_doc.to_dict()
@@ -1290,14 +3247,14 @@ async def unstar_message(message_id: str, current_user = Depends(get_current_use
         
         if current_user['id'] in starred_by:
             starred_by.remove(current_user['id'])
-            message_ref.update({'starred_by': starred_by})
+            await firebase_service.update(message_ref, {'starred_by': starred_by})
     
     return {"message": "Message unstarred"}
 
 @app.get("/messages/starred")
 async def get_starred_messages(current_user = Depends(get_current_user)):
     messages_query = db.collection('messages').where('starred_by', 'array_contains', current_user['id'])
-    messages = messages_query.stream()
+    messages = await firebase_service.stream(messages_query)
     
     starred_messages = []
     for msg_doc in messages:
@@ -1307,50 +3264,113 @@ async def get_starred_messages(current_user = Depends(get_current_user)):
     
     return starred_messages
 
-@app.post("/messages/{message_id}/forward")
-async def forward_message(message_id: str, recipient_ids: List[str], current_user = Depends(get_current_user)):
-    # Get original message
-    original_msg_ref = db.collection('messages').document(message_id)
-    original_msg_doc = original_msg_ref.get()
-    
-    if not original_msg_doc.exists:
-        raise HTTPException(status_code=404, detail="Message not found")
+FORWARD_MAX_MESSAGES = int(os.getenv("FORWARD_MAX_MESSAGES", "50"))
+FORWARD_MAX_RECIPIENTS = int(os.getenv("FORWARD_MAX_RECIPIENTS", "100"))
+
+async def forward_messages(message_ids: List[str], recipient_ids: List[str], current_user: dict) -> dict:
+    """Forward every message to every recipient with batched writes and concurrent emits"""
+    message_ids = list(dict.fromkeys(message_ids))
+    recipient_ids = list(dict.fromkeys(recipient_ids))
+    if not message_ids or not recipient_ids:
+        raise HTTPException(status_code=400, detail="Message IDs and recipient IDs are required")
+    if len(message_ids) > FORWARD_MAX_MESSAGES or len(recipient_ids) > FORWARD_MAX_RECIPIENTS:
+        raise HTTPException(status_code=400, detail=f"Forward at most {FORWARD_MAX_MESSAGES} messages to {FORWARD_MAX_RECIPIENTS} recipients")
     
-    original_message = original_msg_doc.to_dict()
-    forwarded_count = 0
+    # Originals and recipients are each fetched in one round trip
+    original_docs, recipients = await asyncio.gather(
+        firebase_service.get_all([db.collection('messages').document(message_id) for message_id in message_ids]),
+        firebase_service.get_users_by_ids(recipient_ids)
+    )
+    originals = {doc.id: doc.to_dict() for doc in original_docs if doc.exists}
+    for message_id in message_ids:
+        original = originals.get(message_id)
+        if not original or current_user['id'] not in original.get('participants', [original.get('sender_id'), original.get('receiver_id')]):
+            raise HTTPException(status_code=404, detail="Message not found")
     
+    failures = []
+    allowed = []
     for recipient_id in recipient_ids:
-        forwarded_message = {
-            "sender_id": current_user['id'],
-            "receiver_id": recipient_id,
-            "message_text": original_message['message_text'],
-            "timestamp": firestore.SERVER_TIMESTAMP,
-            "status": "sent",
-            "message_type": original_message['message_type'],
-            "file_url": original_message.get('file_url'),
-            "forwarded": True,
-            "original_sender_id": original_message['sender_id'],
-            "starred_by": [],
-            "edited": False,
-            "participants": [current_user['id'], recipient_id]
-        }
+        recipient = recipients.get(recipient_id)
+        if not recipient:
+            failures.append({'recipient_id': recipient_id, 'error': 'User not found'})
+        elif current_user['id'] not in recipient.get('connections', []):
+            failures.append({'recipient_id': recipient_id, 'error': 'Not authorized to message this user'})
+        else:
+            allowed.append(recipient_id)
+    
+    # A batch shares one server timestamp, so explicit timestamps keep the forwarded order
+    sent_at = datetime.now(pytz.utc)
+    pending = []
+    for position, message_id in enumerate(message_ids):
+        original = originals[message_id]
+        for recipient_id in allowed:
+            pending.append((recipient_id, {
+                "sender_id": current_user['id'],
+                "receiver_id": recipient_id,
+                "message_text": original['message_text'],
+                "timestamp": sent_at + timedelta(microseconds=position),
+                "status": "sent",
+                "message_type": original['message_type'],
+                "file_url": original.get('file_url'),
+                "file_variants": original.get('file_variants'),
+                "caption": original.get('caption'),
+                "forwarded": True,
+                "original_sender_id": original['sender_id'],
+                "starred_by": [],
+                "edited": False,
+                "participants": [current_user['id'], recipient_id],
+                "conversation_id": get_conversation_id(current_user['id'], recipient_id)
+            }))
+    
+    forwarded_count = 0
+    for i in range(0, len(pending), MESSAGES_PER_BATCH):
+        batch = db.batch()
+        staged = []
+        for recipient_id, message in pending[i:i + MESSAGES_PER_BATCH]:
+            message_ref = db.collection('messages').document()
+            batch.set(message_ref, message)
+            firebase_service.stage_message_created(batch, message_ref.id, message)
+            staged.append((recipient_id, message_ref.id, message))
         
-        doc_ref = db.collection('messages').add(forwarded_message)
-        forwarded_count += 1
+        try:
+            await firebase_service.call(batch.commit)
+        except Exception as e:
+            print(f"Forward batch failed: {e}")
+            failures.extend({'recipient_id': recipient_id, 'error': str(e)} for recipient_id, _, _ in staged)
+            continue
         
-        # Emit to socket
-        await sio.emit("new_message", {
-            "id": doc_ref[1].id,
-            "sender_id": forwarded_message['sender_id'],
-            "receiver_id": recipient_id,
-            "message_text": forwarded_message['message_text'],
-            "timestamp": get_indian_time().isoformat(),
-            "message_type": forwarded_message['message_type'],
-            "forwarded": True,
-            "sender_name": current_user['name']
-        }, room=f"user_{recipient_id}")
+        forwarded_count += len(staged)
+        await asyncio.gather(*[
+            sio.emit("new_message", {
+                "id": new_message_id,
+                "sender_id": message['sender_id'],
+                "receiver_id": recipient_id,
+                "message_text": message['message_text'],
+                "timestamp": message['timestamp'].isoformat(),
+                "message_type": message['message_type'],
+                "file_url": message['file_url'],
+                "file_variants": message['file_variants'],
+                "caption": message['caption'],
+                "forwarded": True,
+                "sender_name": current_user['name']
+            }, room=f"user_{recipient_id}")
+            for recipient_id, new_message_id, message in staged
+        ], return_exceptions=True)
     
-    return {"message": f"Message forwarded to {forwarded_count} recipients"}
+    return {
+        "message": f"Forwarded {forwarded_count} messages to {len(allowed)} recipients",
+        "forwarded": forwarded_count,
+        "failures": failures
+    }
+
+@app.post("/messages/forward")
+async def forward_messages_bulk(forward_data: MessageForward, current_user = Depends(get_current_user)):
+    """Forward several messages to several chats in one request"""
+    return await forward_messages(forward_data.message_ids, forward_data.recipient_ids, current_user)
+
+@app.post("/messages/{message_id}/forward")
+async def forward_message(message_id: str, recipient_ids: List[str], current_user = Depends(get_current_user)):
+    return await forward_messages([message_id], recipient_ids, current_user)
 
 # ==================== BROADCAST FEATURES ====================
 @app.post("/broadcasts/create")
@@ -1361,14 +3381,14 @@ async def create_broadcast(broadcast_data: BroadcastCreate, current_user = Depen
         "recipient_ids": broadcast_data.recipient_ids,
         "created_at": firestore.SERVER_TIMESTAMP
     }
-    doc_ref = db.collection('broadcasts').add(broadcast)
+    doc_ref = await firebase_service.add(db.collection('broadcasts'), broadcast)
     
     return {"id": doc_ref[1].id, "message": "Broadcast list created"}
 
 @app.get("/broadcasts")
 async def get_broadcasts(current_user = Depends(get_current_user)):
     broadcasts_query = db.collection('broadcasts').where('owner_id', '==', current_user['id'])
-    broadcasts = broadcasts_query.stream()
+    broadcasts = await firebase_service.stream(broadcasts_query)
     
     user_broadcasts = []
     for broadcast_doc in broadcasts:
@@ -1382,45 +3402,91 @@ async def get_broadcasts(current_user = Depends(get_current_user)):
 async def send_broadcast_message(broadcast_id: str, message_data: BroadcastMessage, current_user = Depends(get_current_user)):
     # Get broadcast
     broadcast_ref = db.collection('broadcasts').document(broadcast_id)
-    broadcast_doc = broadcast_ref.get()
+    broadcast_doc = await firebase_service.get(broadcast_ref)
     
     if not broadcast_doc.exists or broadcast_doc.to_dict().get('owner_id') != current_user['id']:
         raise HTTPException(status_code=404, detail="Broadcast not found")
     
     broadcast = broadcast_doc.to_dict()
+    recipient_ids = list(dict.fromkeys(broadcast['recipient_ids']))
+    sender = {'id': current_user['id'], 'name': current_user['name']}
+    
+    async def runner(job: JobContext):
+        return await run_broadcast(job, broadcast_id, recipient_ids, message_data, sender)
+    
+    job_id = await jobs.start('broadcast', current_user['id'], runner, total=len(recipient_ids), broadcast_id=broadcast_id)
+    return {"message": f"Broadcast to {len(recipient_ids)} recipients queued", "job_id": job_id}
+
+async def run_broadcast(job: JobContext, broadcast_id: str, recipient_ids: List[str],
+                        message_data: BroadcastMessage, sender: dict) -> dict:
+    """Write broadcast messages in WriteBatch chunks and fan out socket events concurrently"""
     sent_count = 0
+    failures = []
     
-    for recipient_id in broadcast['recipient_ids']:
-        message = {
-            "sender_id": current_user['id'],
-            "receiver_id": recipient_id,
-            "message_text": message_data.message_text,
-            "timestamp": firestore.SERVER_TIMESTAMP,
-            "status": "sent",
-            "message_type": message_data.message_type,
-            "file_url": message_data.file_url,
-            "broadcast_id": broadcast_id,
-            "starred_by": [],
-            "edited": False,
-            "participants": [current_user['id'], recipient_id]
-        }
+    for i in range(0, len(recipient_ids), MESSAGES_PER_BATCH):
+        batch = db.batch()
+        staged = []
+        for recipient_id in recipient_ids[i:i + MESSAGES_PER_BATCH]:
+            message_ref = db.collection('messages').document()
+            message = {
+                "sender_id": sender['id'],
+                "receiver_id": recipient_id,
+                "message_text": message_data.message_text,
+                "timestamp": firestore.SERVER_TIMESTAMP,
+                "status": "sent",
+                "message_type": message_data.message_type,
+                "file_url": message_data.file_url,
+                "file_variants": message_data.file_variants,
+                "broadcast_id": broadcast_id,
+                "starred_by": [],
+                "edited": False,
+                "participants": [sender['id'], recipient_id],
+                "conversation_id": get_conversation_id(sender['id'], recipient_id)
+            }
+            batch.set(message_ref, message)
+            firebase_service.stage_message_created(batch, message_ref.id, message)
+            staged.append((recipient_id, message_ref.id, message))
         
-        doc_ref = db.collection('messages').add(message)
-        sent_count += 1
+        try:
+            await firebase_service.call(batch.commit)
+        except Exception as e:
+            print(f"Broadcast {broadcast_id} chunk failed: {e}")
+            failures.extend({'recipient_id': recipient_id, 'error': str(e)} for recipient_id, _, _ in staged)
+            await job.update(processed=i + len(staged), sent=sent_count, failures=failures)
+            continue
         
-        # Emit to socket
-        await sio.emit("new_message", {
-            "id": doc_ref[1].id,
-            "sender_id": message['sender_id'],
-            "receiver_id": recipient_id,
-            "message_text": message['message_text'],
-            "timestamp": get_indian_time().isoformat(),
-            "message_type": message['message_type'],
-            "broadcast_id": broadcast_id,
-            "sender_name": current_user['name']
-        }, room=f"user_{recipient_id}")
+        sent_count += len(staged)
+        timestamp = get_indian_time().isoformat()
+        results = await asyncio.gather(*[
+            sio.emit("new_message", {
+                "id": message_id,
+                "sender_id": message['sender_id'],
+                "receiver_id": recipient_id,
+                "message_text": message['message_text'],
+                "timestamp": timestamp,
+                "message_type": message['message_type'],
+                "file_url": message['file_url'],
+                "file_variants": message['file_variants'],
+                "broadcast_id": broadcast_id,
+                "sender_name": sender['name']
+            }, room=f"user_{recipient_id}")
+            for recipient_id, message_id, message in staged
+        ], return_exceptions=True)
+        for (recipient_id, _, _), result in zip(staged, results):
+            if isinstance(result, Exception):
+                failures.append({'recipient_id': recipient_id, 'error': f"delivery failed: {result}"})
+        
+        await job.update(processed=i + len(staged), sent=sent_count, failures=failures)
     
-    return {"message": f"Broadcast sent to {sent_count} recipients"}
+    return {'sent': sent_count, 'failures': failures}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, current_user = Depends(get_current_user)):
+    """Status of a background job started by the current user"""
+    job = await jobs.get(job_id, current_user['id'])
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
 # ==================== USER BLOCKING ====================
 @app.post("/users/block")
@@ -1429,7 +3495,7 @@ async def block_user(user_data: dict, current_user = Depends(get_current_user)):
     
     # Check if already blocked
     blocked_query = db.collection('blocked_users').where('blocker_id', '==', current_user['id']).where('blocked_id', '==', user_id)
-    existing = list(blocked_query.stream())
+    existing = await firebase_service.stream(blocked_query)
     
     if not existing:
         blocked_user = {
@@ -1437,33 +3503,32 @@ async def block_user(user_data: dict, current_user = Depends(get_current_user)):
             "blocked_id": user_id,
             "blocked_at": firestore.SERVER_TIMESTAMP
         }
-        db.collection('blocked_users').add(blocked_user)
+        await firebase_service.add(db.collection('blocked_users'), blocked_user)
     
     return {"message": "User blocked"}
 
 @app.delete("/users/block/{user_id}")
 async def unblock_user(user_id: str, current_user = Depends(get_current_user)):
     blocked_query = db.collection('blocked_users').where('blocker_id', '==', current_user['id']).where('blocked_id', '==', user_id)
-    docs = blocked_query.stream()
+    docs = await firebase_service.stream(blocked_query)
     for doc in docs:
-        doc.reference.delete()
+        await firebase_service.delete(doc.reference)
     return {"message": "User unblocked"}
 
 @app.get("/users/blocked")
 async def get_blocked_users(current_user = Depends(get_current_user)):
     blocked_query = db.collection('blocked_users').where('blocker_id', '==', current_user['id'])
-    blocked_docs = blocked_query.stream()
+    blocked_docs = await firebase_service.stream(blocked_query)
+    
+    blocked_entries = [blocked_doc.to_dict() for blocked_doc in blocked_docs]
+    users = await firebase_service.get_users_by_ids(entry['blocked_id'] for entry in blocked_entries)
     
     user_blocked = []
-    for blocked_doc in blocked_docs:
-        blocked_data = blocked_doc.to_dict()
-        
-        # Get user details
-        user_doc = db.collection('users').document(blocked_data['blocked_id']).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
+    for blocked_data in blocked_entries:
+        user_data = users.get(blocked_data['blocked_id'])
+        if user_data:
             user_blocked.append({
-                "id": user_data['id'] if 'id' in user_data else blocked_data['blocked_id'],
+                "id": user_data['id'],
                 "name": user_data['name'],
                 "email": user_data['email'],
                 "blocked_at": blocked_data['blocked_at']
@@ -1476,7 +3541,7 @@ async def get_blocked_users(current_user = Depends(get_current_user)):
 async def get_notifications(current_user = Depends(get_current_user)):
     # Use simple query without ordering to avoid index requirement
     notifications_query = db.collection('notifications').where('user_id', '==', current_user['id'])
-    notifications = notifications_query.stream()
+    notifications = await firebase_service.stream(notifications_query)
     
     user_notifications = []
     for notification_doc in notifications:
@@ -1491,10 +3556,10 @@ async def get_notifications(current_user = Depends(get_current_user)):
 @app.put("/notifications/{notification_id}/read")
 async def mark_notification_read(notification_id: str, current_user = Depends(get_current_user)):
     notification_ref = db.collection('notifications').document(notification_id)
-    notification_doc = notification_ref.get()
+    notification_doc = await firebase_service.get(notification_ref)
     
     if notification_doc.exists and notification_doc.to_dict().get('user_id') == current_user['id']:
-        notification_ref.update({
+        await firebase_service.update(notification_ref, {
             'read': True,
             'read_at': firestore.SERVER_TIMESTAMP
         })
@@ -1505,18 +3570,16 @@ async def mark_notification_read(notification_id: str, current_user = Depends(ge
 @app.delete("/notifications/{notification_id}")
 async def delete_notification(notification_id: str, current_user = Depends(get_current_user)):
     notification_ref = db.collection('notifications').document(notification_id)
-    notification_doc = notification_ref.get()
+    notification_doc = await firebase_service.get(notification_ref)
     
     if notification_doc.exists and notification_doc.to_dict().get('user_id') == current_user['id']:
-        notification_ref.delete()
+        await firebase_service.delete(notification_ref)
         return {"message": "Notification deleted"}
     
     raise HTTPException(status_code=404, detail="Notification not found")
 
 
 
-from fastapi.responses import FileResponse
-
 @app.get("/call")
 async def call_page():
     return FileResponse("call.html", media_type="text/html")
@@ -1531,7 +3594,9 @@ async def get_chat_requests(current_user = Depends(get_current_user)):
             raise HTTPException(status_code=401, detail="Authentication required")
             
         chat_requests_query = db.collection('chat_requests').where('receiver_id', '==', current_user['id']).where('status', '==', 'pending')
-        chat_requests = chat_requests_query.stream()
+        chat_requests = await firebase_service.stream(chat_requests_query)
+        
+        senders = await firebase_service.get_users_by_ids(request_doc.to_dict().get('sender_id') for request_doc in chat_requests)
         
         received_requests = []
         for request_doc in chat_requests:
@@ -1540,9 +3605,8 @@ async def get_chat_requests(current_user = Depends(get_current_user)):
                 request_data['id'] = request_doc.id
                 
                 # Get sender details
-                sender_doc = db.collection('users').document(request_data['sender_id']).get()
-                if sender_doc.exists:
-                    sender_data = sender_doc.to_dict()
+                sender_data = senders.get(request_data['sender_id'])
+                if sender_data:
                     request_data['sender_name'] = sender_data['name']
                     request_data['sender_email'] = sender_data['email']
                     received_requests.append(request_data)
@@ -1565,7 +3629,7 @@ async def respond_to_chat_request(request_id: str, response_data: dict, current_
     action = response_data.get('action')  # 'accept' or 'decline'
     
     request_ref = db.collection('chat_requests').document(request_id)
-    request_doc = request_ref.get()
+    request_doc = await firebase_service.get(request_ref)
     
     if not request_doc.exists or request_doc.to_dict().get('receiver_id') != current_user['id']:
         raise HTTPException(status_code=404, detail="Request not found")
@@ -1573,7 +3637,7 @@ async def respond_to_chat_request(request_id: str, response_data: dict, current_
     request_data = request_doc.to_dict()
     
     # Update request status
-    request_ref.update({
+    await firebase_service.update(request_ref, {
         'status': 'accepted' if action == 'accept' else 'declined',
         'responded_at': firestore.SERVER_TIMESTAMP
     })
@@ -1584,20 +3648,24 @@ async def respond_to_chat_request(request_id: str, response_data: dict, current_
         sender_ref = db.collection('users').document(request_data['sender_id'])
         
         # Update current user's connections
-        current_user_doc = current_user_ref.get()
+        current_user_doc = await firebase_service.get(current_user_ref)
         if current_user_doc.exists:
             connections = current_user_doc.to_dict().get('connections', [])
             if request_data['sender_id'] not in connections:
                 connections.append(request_data['sender_id'])
-                current_user_ref.update({'connections': connections})
+                await firebase_service.update(current_user_ref, {'connections': connections})
+                auth_cache.invalidate_user(current_user['id'])
+                connection_graph.invalidate(current_user['id'])
         
         # Update sender's connections
-        sender_doc = sender_ref.get()
+        sender_doc = await firebase_service.get(sender_ref)
         if sender_doc.exists:
             connections = sender_doc.to_dict().get('connections', [])
             if current_user['id'] not in connections:
                 connections.append(current_user['id'])
-                sender_ref.update({'connections': connections})
+                await firebase_service.update(sender_ref, {'connections': connections})
+                auth_cache.invalidate_user(request_data['sender_id'])
+                connection_graph.invalidate(request_data['sender_id'])
     
     # Emit response to sender
     await sio.emit('chat_request_response', {
@@ -1609,61 +3677,199 @@ async def respond_to_chat_request(request_id: str, response_data: dict, current_
     return {"message": f"Chat request {action}ed"}
 @app.delete("/users/me")
 async def delete_account(current_user = Depends(get_current_user)):
-    """Delete user account"""
+    """Delete user account; the login, profile and data are removed by a background job"""
+    user_id = current_user['id']
     try:
-        # Delete user from Firebase Auth
-        auth.delete_user(current_user['id'])
-        
-        # Delete user document from Firestore
-        db.collection('users').document(current_user['id']).delete()
-        
-        # Delete user's messages
-        messages_query = db.collection('messages').where('participants', 'array_contains', current_user['id'])
-        messages = messages_query.stream()
-        for msg in messages:
-            msg.reference.delete()
+        # The job exists before anything is removed, so an interrupted deletion is resumed
+        # rather than leaving an account without a login but with all of its data
+        job_id = await jobs.start(
+            'delete_account', user_id, run_account_deletion,
+            connections=current_user.get('connections', []),
+            completed_steps=[]
+        )
+        auth_cache.invalidate_user(user_id)
+        connection_graph.invalidate(user_id)
         
-        return {"message": "Account deleted successfully"}
+        return {"message": "Account deletion started, removing data in the background", "job_id": job_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting account: {str(e)}")
 
+@app.get("/users/deletions/{job_id}")
+async def get_account_deletion(job_id: str):
+    """Progress of an account deletion; the login may already be gone, so no auth"""
+    job_doc = await firebase_service.get(db.collection('jobs').document(job_id))
+    if not job_doc.exists or job_doc.to_dict().get('type') != 'delete_account':
+        raise HTTPException(status_code=404, detail="Job not found")
+    job = job_doc.to_dict()
+    return {
+        "id": job_doc.id,
+        "status": job['status'],
+        "processed": job.get('processed', 0),
+        "completed_steps": job.get('completed_steps', []),
+        "current_step": job.get('current_step')
+    }
+
+# ==================== ACCOUNT DELETION ====================
+# Every step is idempotent: it re-queries whatever still matches, so a resumed
+# job simply repeats its unfinished step. Finished steps are checkpointed by name.
+# Files are never unlinked here: content-addressed uploads are released by
+# reference count and reclaimed by the orphan sweeper, and URLs on profiles or
+# statuses are client-supplied, so they cannot prove ownership of a file.
+
+async def delete_account_record(user_id: str) -> int:
+    """Remove the login, the user document (releasing its profile photo) and the directory entry"""
+    try:
+        await firebase_service.call(auth.delete_user, user_id)
+    except auth.UserNotFoundError:
+        pass
+    auth_cache.invalidate_user(user_id)
+    connection_graph.invalidate(user_id)
+    
+    user_ref = db.collection('users').document(user_id)
+    while True:
+        user_doc = await firebase_service.get(user_ref)
+        if not user_doc.exists:
+            break
+        # Guarded so a profile photo changed meanwhile is the one released
+        batch = db.batch()
+        batch.delete(user_ref, option=db.write_option(last_update_time=user_doc.update_time))
+        firebase_service.stage_upload_refs(batch, [user_doc.to_dict().get('profile_image_url')], -1)
+        try:
+            await firebase_service.call(batch.commit)
+            break
+        except (FailedPrecondition, NotFound):
+            continue
+    
+    await firebase_service.remove_directory_entry(user_id)
+    return 1
+
+async def leave_account_groups(user_id: str, report) -> int:
+    query = db.collection('groups').where('member_ids', 'array_contains', user_id).limit(FIRESTORE_BATCH_LIMIT)
+    left = 0
+    while True:
+        docs = await firebase_service.stream(query)
+        if not docs:
+            return left
+        batch = db.batch()
+        for doc in docs:
+            batch.update(doc.reference, {
+                'member_ids': firestore.ArrayRemove([user_id]),
+                'admin_ids': firestore.ArrayRemove([user_id])
+            })
+        await firebase_service.call(batch.commit)
+        left += len(docs)
+        await report(left)
+
+async def detach_account_connections(user_id: str, connection_ids: List[str], report) -> int:
+    """Drop the user from their connections' lists and inboxes"""
+    peer_ids = list(await firebase_service.get_users_by_ids(connection_ids))
+    chunk_size = FIRESTORE_BATCH_LIMIT // 2
+    for i in range(0, len(peer_ids), chunk_size):
+        chunk = peer_ids[i:i + chunk_size]
+        batch = db.batch()
+        for peer_id in chunk:
+            batch.update(db.collection('users').document(peer_id), {'connections': firestore.ArrayRemove([user_id])})
+            batch.delete(firebase_service.inbox_ref(peer_id, get_conversation_id(user_id, peer_id)))
+        await firebase_service.call(batch.commit)
+        for peer_id in chunk:
+            auth_cache.invalidate_user(peer_id)
+            connection_graph.invalidate(peer_id)
+        await report(i + len(chunk))
+    return len(peer_ids)
+
+def account_deletion_steps(user_id: str, job_data: dict) -> list:
+    """(name, step) pairs in execution order; step(report) returns the number of documents handled"""
+    def delete_where(collection: str, field: str, op: str = '=='):
+        query = db.collection(collection).where(field, op, user_id)
+        return lambda report: firebase_service.delete_query(query, on_progress=report)
+    
+    inbox = db.collection('users').document(user_id).collection('inbox')
+    messages = db.collection('messages').where('participants', 'array_contains', user_id)
+    statuses = db.collection('statuses').where('user_id', '==', user_id)
+    
+    def release_status_media(batch, doc):
+        firebase_service.stage_upload_refs(batch, [doc.to_dict().get('media_url')], -1)
+    
+    return [
+        ('account', lambda report: delete_account_record(user_id)),
+        ('messages', lambda report: firebase_service.delete_messages(messages, on_progress=report)),
+        ('search_index', delete_where('search_index', 'user_id')),
+        ('inbox', lambda report: firebase_service.delete_query(inbox, on_progress=report)),
+        ('statuses', lambda report: firebase_service.delete_query(statuses, on_progress=report, ops_per_doc=2, stage=release_status_media)),
+        ('chat_requests_sent', delete_where('chat_requests', 'sender_id')),
+        ('chat_requests_received', delete_where('chat_requests', 'receiver_id')),
+        ('blocked_users', delete_where('blocked_users', 'blocker_id')),
+        ('blocked_by', delete_where('blocked_users', 'blocked_id')),
+        ('pinned_chats', delete_where('pinned_chats', 'user_id')),
+        ('pinned_by', delete_where('pinned_chats', 'chat_id')),
+        ('archived_chats', delete_where('archived_chats', 'user_id')),
+        ('archived_by', delete_where('archived_chats', 'chat_id')),
+        ('notifications', delete_where('notifications', 'user_id')),
+        ('calls', delete_where('calls', 'participants', 'array_contains')),
+        ('broadcasts', delete_where('broadcasts', 'owner_id')),
+        ('groups', lambda report: leave_account_groups(user_id, report)),
+        ('connections', lambda report: detach_account_connections(user_id, job_data.get('connections', []), report)),
+    ]
+
+async def run_account_deletion(job: JobContext) -> dict:
+    user_id = job.data['owner_id']
+    completed = list(job.data.get('completed_steps', []))
+    processed = job.data.get('processed', 0)
+    
+    for name, step in account_deletion_steps(user_id, job.data):
+        if name in completed:
+            continue
+        
+        async def report(count: int, base: int = processed, name: str = name):
+            await job.update(processed=base + count, current_step=name)
+        
+        await job.update(current_step=name)
+        processed += await step(report)
+        completed.append(name)
+        await job.update(completed_steps=completed, processed=processed)
+        print(f"Account deletion {job.id}: {name} done")
+    
+    return {'processed': processed, 'current_step': None}
+
+async def recover_jobs():
+    """Background task taking over jobs left running by stopped processes once their lease expires"""
+    while True:
+        await jobs.resume('delete_account', run_account_deletion)
+        await jobs.resume('clear_chat', run_clear_chat_job)
+        # Rerunning a broadcast would send its first recipients the message twice
+        await jobs.fail_abandoned('broadcast', "Interrupted by a server restart")
+        await asyncio.sleep(JOB_STALE_AFTER)
+
+SEARCH_PAGE_DEFAULT_LIMIT = 20
+SEARCH_PAGE_MAX_LIMIT = 50
+
 @app.get("/search")
-async def search_messages(q: str, current_user = Depends(get_current_user)):
-    # Search in messages - Note: Firestore doesn't support full-text search natively
-    # This is a basic implementation - consider using Algolia or Elasticsearch for production
-    messages_query = db.collection('messages').where('participants', 'array_contains', current_user['id'])
-    messages = messages_query.stream()
+async def search_messages(q: str, limit: int = SEARCH_PAGE_DEFAULT_LIMIT, offset: int = 0,
+                          current_user = Depends(get_current_user)):
+    # Messages come from the per-user token index, ranked and paginated
+    limit = max(1, min(limit, SEARCH_PAGE_MAX_LIMIT))
+    offset = max(0, offset)
+    search_page = await firebase_service.search_messages(current_user['id'], q, limit=limit, offset=offset)
+    matches = search_page['results']
     
-    message_results = []
-    for msg_doc in messages:
-        msg_data = msg_doc.to_dict()
-        if q.lower() in msg_data.get('message_text', '').lower():
-            msg_data['id'] = msg_doc.id
-            
-            # Get other user details
-            other_user_id = msg_data['receiver_id'] if msg_data['sender_id'] == current_user['id'] else msg_data['sender_id']
-            other_user_doc = db.collection('users').document(other_user_id).get()
-            
-            if other_user_doc.exists:
-                other_user_data = other_user_doc.to_dict()
-                message_results.append({
-                    "message": msg_data,
-                    "other_user": other_user_data
-                })
+    # Get other user details in one batched read
+    def other_user_id(msg_data):
+        return msg_data['receiver_id'] if msg_data['sender_id'] == current_user['id'] else msg_data['sender_id']
+    other_users = await firebase_service.get_users_by_ids(other_user_id(msg_data) for msg_data in matches)
     
-    # Search in users
-    users_query = db.collection('users')
-    users = users_query.stream()
+    message_results = []
+    for msg_data in matches:
+        other_user_data = other_users.get(other_user_id(msg_data))
+        if other_user_data:
+            message_results.append({
+                "message": msg_data,
+                "other_user": other_user_data
+            })
     
-    user_results = []
-    for user_doc in users:
-        user_data = user_doc.to_dict()
-        if user_doc.id != current_user['id'] and \
-           (q.lower() in user_data.get('name', '').lower() or q.lower() in user_data.get('email', '').lower()):
-            user_data['id'] = user_doc.id
-            user_results.append(user_data)
+    # Search in the discoverable user directory
+    user_results = await firebase_service.search_directory(q, exclude_user_id=current_user['id'])
     
-    return {"messages": message_results, "users": user_results}
+    return {"messages": message_results, "users": user_results, "has_more": search_page['has_more']}
 
 # Group routes
 @app.post("/groups/create")
@@ -1697,7 +3903,7 @@ async def create_group(group_data: GroupCreate, current_user = Depends(get_curre
         "created_by": current_user['id']
     }
     
-    doc_ref = db.collection('groups').add(group)
+    doc_ref = await firebase_service.add(db.collection('groups'), group)
     group_id = doc_ref[1].id
     
     # Emit group creation to all members
@@ -1719,7 +3925,7 @@ async def create_group(group_data: GroupCreate, current_user = Depends(get_curre
 @app.get("/groups")
 async def get_groups(current_user = Depends(get_current_user)):
     groups_query = db.collection('groups').where('member_ids', 'array_contains', current_user['id'])
-    groups = groups_query.stream()
+    groups = await firebase_service.stream(groups_query)
     
     user_groups = []
     for group_doc in groups:
@@ -1734,54 +3940,88 @@ async def get_groups(current_user = Depends(get_current_user)):
     return user_groups
 
 # Socket.IO events
+def get_socket_token(environ: dict, auth_data) -> Optional[str]:
+    """ID token from the handshake auth payload or Authorization header.
+
+    Never from the query string: it is repeated on every polling request and
+    lands in access logs.
+    """
+    if isinstance(auth_data, dict) and auth_data.get('token'):
+        return auth_data['token']
+    header = environ.get('HTTP_AUTHORIZATION', '')
+    if header.lower().startswith('bearer '):
+        return header[7:]
+    return None
+
+async def get_socket_user_id(sid) -> Optional[str]:
+    """User id verified at connect time, kept in the Socket.IO session"""
+    session = await sio.get_session(sid)
+    return session.get('user_id')
+
 @sio.event
 async def connect(sid, environ, auth=None):
-    print(f"Client {sid} connected")
+    token = get_socket_token(environ, auth)
+    if not token:
+        print(f"Client {sid} rejected: no token")
+        raise socketio.exceptions.ConnectionRefusedError('Authorization token required')
+    
+    try:
+        decoded_token, user_data = await auth_cache.verify(token)
+    except Exception as e:
+        print(f"Client {sid} rejected: {str(e)}")
+        raise socketio.exceptions.ConnectionRefusedError('Invalid authentication token')
+    
+    if user_data is None:
+        # Cache the verified token like get_current_user, so the client's HTTP calls skip verification
+        user_doc = await firebase_service.get(db.collection('users').document(decoded_token['uid']))
+        if not user_doc.exists:
+            print(f"Client {sid} rejected: no user document for {decoded_token['uid']}")
+            raise socketio.exceptions.ConnectionRefusedError('User not found')
+        auth_cache.put(token, decoded_token, {'id': user_doc.id, **user_doc.to_dict()})
+    
+    await sio.save_session(sid, {'user_id': decoded_token['uid']})
+    print(f"Client {sid} connected as {decoded_token['uid']}")
     return True
 
 @sio.event
 async def disconnect(sid):
     print(f"Client {sid} disconnected")
-    user_id = None
-    for uid, session_data in user_sessions.items():
-        if session_data.get('sid') == sid:
-            user_id = uid
-            break
+    record, last_device = sessions.remove(sid)
+    if record:
+        await presence.store.set_devices(record.user_id, sessions.device_count(record.user_id))
     
-    if user_id:
-        online_users.pop(user_id, None)
-        user_sessions.pop(user_id, None)
+    # Other devices, on this node or any other, keep the user online
+    if last_device and not await presence.store.device_count(record.user_id):
+        user_id = record.user_id
         await update_user_status(user_id, False)
         
-        # Emit user offline status to all connected users
-        await sio.emit('user_offline', {
+        # Emit user offline status to their connections
+        await emit_presence('user_offline', user_id, {
             'user_id': user_id,
             'last_seen': get_indian_time().isoformat() + 'Z'
         }, skip_sid=sid)
 
 @sio.event
-async def join_room(sid, data):
-    user_id = data.get("user_id")
+async def join_room(sid, data=None):
+    user_id = await get_socket_user_id(sid)
     if user_id:
         sio.enter_room(sid, f"user_{user_id}")
-        # Track online user
-        online_users[user_id] = {
-            'sid': sid,
-            'connected_at': get_indian_time().isoformat() + 'Z'
-        }
-        user_sessions[user_id] = {'sid': sid}
+        # Track this device; only the first one across all nodes announces the user online
+        record, first_device = sessions.add(user_id, sid)
+        await presence.store.set_devices(user_id, sessions.device_count(user_id))
         await update_user_status(user_id, True)
         
-        # Emit user online status to all connected users immediately
-        await sio.emit('user_online', {
-            'user_id': user_id,
-            'timestamp': get_indian_time().isoformat() + 'Z'
-        })
+        if first_device and await presence.store.device_count(user_id) <= sessions.device_count(user_id):
+            # Emit user online status to their connections immediately
+            await emit_presence('user_online', user_id, {
+                'user_id': user_id,
+                'timestamp': get_indian_time().isoformat() + 'Z'
+            })
 
 @sio.event
 async def typing(sid, data):
     receiver_id = data.get('receiver_id')
-    user_id = data.get('user_id')
+    user_id = await get_socket_user_id(sid)
     is_typing = data.get('is_typing')
     
     if receiver_id and user_id is not None:
@@ -1796,7 +4036,7 @@ async def webrtc_signal(sid, data):
     target_user = data.get('target_user')
     signal = data.get('signal')
     call_id = data.get('call_id')
-    from_user = data.get('from_user')
+    from_user = await get_socket_user_id(sid)
     
     if target_user and signal:
         print(f"Relaying WebRTC signal from {from_user} to {target_user} for call {call_id}")
@@ -1819,7 +4059,7 @@ async def screen_share_status(sid, data):
     target_user = data.get('target_user')
     is_sharing = data.get('is_sharing')
     call_id = data.get('call_id')
-    from_user = data.get('from_user')
+    from_user = await get_socket_user_id(sid)
     
     if target_user is not None:
         print(f"Relaying screen share status from {from_user} to {target_user} for call {call_id}: {is_sharing}")
@@ -1837,17 +4077,106 @@ async def screen_share_status(sid, data):
         print(f"Invalid screen share status data: {data}")
 
 @sio.event
-async def heartbeat(sid, data):
-    user_id = data.get('user_id')
-    if user_id and user_id in online_users:
-        online_users[user_id]['last_heartbeat'] = get_indian_time().isoformat() + 'Z'
-        await update_user_status(user_id, True)
+async def heartbeat(sid, data=None):
+    # The sid already identifies the user; any client-sent user_id is ignored
+    record = sessions.get(sid)
+    if not record:
+        # The session expired (or never joined) but the socket is alive: register it again
+        await join_room(sid)
+        record = sessions.get(sid)
+    if record:
+        # No Firestore write; the first heartbeat arms expiry, later ones re-arm lazily
+        record.last_heartbeat = time.monotonic()
+        heartbeat_expiry.schedule(record)
+        await presence.refresh(record.user_id)
+
+
+
+# ==================== MIGRATIONS ====================
+def migrate_collection(name: str, collection: str, apply, batch_size: int = 200, restart: bool = False):
+    """Walk every document of a collection in id order, letting apply(batch, doc) stage writes.
+
+    Progress is checkpointed in migrations/{name} after every page, so an
+    interrupted run picks up from the last processed document.
+    """
+    checkpoint_ref = db.collection('migrations').document(name)
+    checkpoint = checkpoint_ref.get()
+    state = checkpoint.to_dict() if checkpoint.exists and not restart else {}
+    last_id = state.get('last_id')
+    updated = state.get('updated', 0)
+    
+    while True:
+        query = db.collection(collection).order_by(firestore.FieldPath.document_id()).limit(batch_size)
+        if last_id:
+            query = query.start_after({firestore.FieldPath.document_id(): db.collection(collection).document(last_id)})
+        docs = list(query.stream())
+        if not docs:
+            break
+        
+        batch = db.batch()
+        pending = sum(1 for doc in docs if apply(batch, doc))
+        if pending:
+            batch.commit()
+        
+        updated += pending
+        last_id = docs[-1].id
+        checkpoint_ref.set({'last_id': last_id, 'updated': updated, 'updated_at': firestore.SERVER_TIMESTAMP})
+        print(f"[{name}] processed up to {last_id}, {updated} documents updated")
+    
+    print(f"[{name}] complete: {updated} documents updated")
+
+def backfill_conversation_ids(batch: firestore.WriteBatch, doc) -> bool:
+    """Stamp conversation_id on messages written before it existed"""
+    msg_data = doc.to_dict()
+    if msg_data.get('conversation_id') or not msg_data.get('sender_id'):
+        return False
+    if not msg_data.get('receiver_id') and not msg_data.get('group_id'):
+        return False
+    batch.update(doc.reference, {
+        'conversation_id': get_conversation_id(msg_data['sender_id'], msg_data.get('receiver_id'), msg_data.get('group_id'))
+    })
+    return True
+
+def backfill_search_index(batch: firestore.WriteBatch, doc) -> bool:
+    """Create search entries for messages sent before the index existed (max 2 writes per message)"""
+    msg_data = message_conversation(doc.to_dict())
+    text = ' '.join(filter(None, [msg_data.get('message_text'), msg_data.get('caption')]))
+    for user_id in set(filter(None, msg_data['participants'])):
+        batch.set(firebase_service.search_entry_ref(user_id, doc.id), {
+            'user_id': user_id,
+            'message_id': doc.id,
+            'conversation_id': msg_data['conversation_id'],
+            'words': search_words(text),
+            'tokens': search_tokens(text),
+            'timestamp': msg_data.get('timestamp')
+        })
+    return True
 
+def backfill_user_directory(batch: firestore.WriteBatch, doc) -> bool:
+    """Publish existing users to the directory according to their privacy settings"""
+    user_data = {'id': doc.id, **doc.to_dict()}
+    entry_ref = db.collection('user_directory').document(doc.id)
+    if get_privacy_settings(user_data).public_discovery:
+        batch.set(entry_ref, directory_entry(user_data))
+    else:
+        batch.delete(entry_ref)
+    return True
 
+MIGRATIONS = {
+    'backfill-conversations': ('conversation_ids', 'messages', backfill_conversation_ids),
+    'backfill-search-index': ('search_index', 'messages', backfill_search_index),
+    'backfill-user-directory': ('user_directory', 'users', backfill_user_directory)
+}
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(socket_app, host="0.0.0.0", port=8000, reload=True)
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] in MIGRATIONS:
+        # python main.py <migration> [--restart]
+        migration_name, collection, apply = MIGRATIONS[sys.argv[1]]
+        migrate_collection(migration_name, collection, apply, restart="--restart" in sys.argv)
+    else:
+        import uvicorn
+        uvicorn.run(socket_app, host="0.0.0.0", port=8000, reload=True)
 
 # For Render deployment
 app = socket_app
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# main initializes Firebase and creates its working directories at import time;
+# keep both away from real credentials and the checkout.
+os.chdir(tempfile.mkdtemp(prefix="widechat-tests-"))
+with mock.patch("firebase_admin.credentials.Certificate"), \
+        mock.patch("firebase_admin.initialize_app"), \
+        mock.patch("firebase_admin.firestore.client"):
+    import main  # noqa: E402,F401
@@ -0,0 +1,52 @@
+import time
+
+import pytest
+
+import main
+from main import AuthCache
+
+
+@pytest.fixture
+def auth_cache():
+    return AuthCache(ttl=300, revocation_interval=60, max_entries=3)
+
+
+def claims(uid: str, lifetime: float = 3600) -> dict:
+    return {'uid': uid, 'exp': time.time() + lifetime}
+
+
+def test_auth_cache_hit(auth_cache):
+    auth_cache.put('token-1', claims('alice'), {'id': 'alice'})
+    assert auth_cache.get('token-1')['user'] == {'id': 'alice'}
+    assert auth_cache.get('token-2') is None
+
+
+def test_auth_cache_never_outlives_the_token(auth_cache):
+    auth_cache.put('token-1', claims('alice', lifetime=-1), {'id': 'alice'})
+    assert auth_cache.get('token-1') is None
+    assert 'alice' not in auth_cache.user_tokens
+
+
+def test_auth_cache_expires_after_ttl(auth_cache, monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(main.time, 'monotonic', lambda: now)
+    auth_cache.put('token-1', claims('alice'), {'id': 'alice'})
+    monkeypatch.setattr(main.time, 'monotonic', lambda: now + 301)
+    assert auth_cache.get('token-1') is None
+
+
+def test_auth_cache_invalidates_every_token_of_a_user(auth_cache):
+    auth_cache.put('token-1', claims('alice'), {'id': 'alice'})
+    auth_cache.put('token-2', claims('alice'), {'id': 'alice'})
+    auth_cache.put('token-3', claims('bob'), {'id': 'bob'})
+    auth_cache.invalidate_user('alice')
+    assert auth_cache.get('token-1') is None and auth_cache.get('token-2') is None
+    assert auth_cache.get('token-3') is not None
+
+
+def test_auth_cache_evicts_when_full(auth_cache):
+    for i in range(4):
+        auth_cache.put(f'token-{i}', claims(f'user-{i}'), {'id': f'user-{i}'})
+    assert len(auth_cache.entries) == 3
+    assert auth_cache.get('token-0') is None
+    assert 'user-0' not in auth_cache.user_tokens
@@ -0,0 +1,25 @@
+from datetime import datetime
+
+import pytest
+import pytz
+from fastapi import HTTPException
+
+from main import decode_message_cursor, encode_message_cursor
+
+
+def test_message_cursor_round_trip():
+    timestamp = datetime(2024, 5, 1, 12, 30, 15, 250000, tzinfo=pytz.utc)
+    cursor = encode_message_cursor({'id': 'msg-1', 'timestamp': timestamp})
+    assert decode_message_cursor(cursor) == (timestamp, 'msg-1')
+
+
+def test_message_cursor_is_url_safe():
+    cursor = encode_message_cursor({'id': '??>>', 'timestamp': datetime(2024, 1, 1, tzinfo=pytz.utc)})
+    assert '+' not in cursor and '/' not in cursor
+
+
+@pytest.mark.parametrize('cursor', ['not-a-cursor', '', encode_message_cursor({'id': 'msg-1'})])
+def test_invalid_message_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_message_cursor(cursor)
+    assert error.value.status_code == 400
@@ -0,0 +1,51 @@
+import time
+
+import main
+from main import HeartbeatExpiry, SessionRegistry
+
+
+def test_expiry_after_timeout():
+    expiry = HeartbeatExpiry(30)
+    record, _ = SessionRegistry().add('alice', 'sid-1')
+    expiry.schedule(record)
+    start = record.last_heartbeat
+    assert expiry.pop_expired(start + 29) == []
+    assert expiry.pop_expired(start + 30) == [record]
+    assert not record.active
+    assert expiry.heap == []
+
+
+def test_heartbeat_rearms_lazily():
+    expiry = HeartbeatExpiry(30)
+    record, _ = SessionRegistry().add('alice', 'sid-1')
+    expiry.schedule(record)
+    start = record.last_heartbeat
+    record.last_heartbeat = start + 20
+    assert expiry.pop_expired(start + 31) == []
+    assert len(expiry.heap) == 1
+    assert expiry.pop_expired(start + 50) == [record]
+
+
+def test_schedule_arms_a_session_once():
+    expiry = HeartbeatExpiry(30)
+    record, _ = SessionRegistry().add('alice', 'sid-1')
+    expiry.schedule(record)
+    expiry.schedule(record)
+    assert len(expiry.heap) == 1
+
+
+def test_removed_sessions_are_skipped():
+    expiry = HeartbeatExpiry(30)
+    sessions = SessionRegistry()
+    record, _ = sessions.add('alice', 'sid-1')
+    expiry.schedule(record)
+    sessions.remove('sid-1')
+    assert expiry.pop_expired(record.last_heartbeat + 60) == []
+
+
+def test_seconds_until_next_is_bounded():
+    expiry = HeartbeatExpiry(30)
+    assert expiry.seconds_until_next(time.monotonic()) == main.HEARTBEAT_CHECK_INTERVAL
+    record, _ = SessionRegistry().add('alice', 'sid-1')
+    expiry.schedule(record)
+    assert expiry.seconds_until_next(record.last_heartbeat + 29.9) == 0.5
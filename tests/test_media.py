@@ -0,0 +1,46 @@
+import pytest
+from fastapi import HTTPException
+
+from main import etag_matches, parse_byte_range, stored_upload_digest
+
+DIGEST = 'ab' * 32
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', (0, 99)),
+    ('bytes=100-', (100, 999)),
+    ('bytes=-100', (900, 999)),
+    ('bytes=900-5000', (900, 999)),
+    ('bytes=-5000', (0, 999)),
+])
+def test_parse_byte_range(header, expected):
+    assert parse_byte_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header', ['items=0-10', 'bytes=0-10,20-30', 'bytes=a-b'])
+def test_unsupported_byte_range_serves_whole_file(header):
+    assert parse_byte_range(header, 1000) is None
+
+
+@pytest.mark.parametrize('header', ['bytes=1000-', 'bytes=500-100'])
+def test_unsatisfiable_byte_range(header):
+    with pytest.raises(HTTPException) as error:
+        parse_byte_range(header, 1000)
+    assert error.value.status_code == 416
+    assert error.value.headers['Content-Range'] == 'bytes */1000'
+
+
+def test_etag_matches():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('W/"abc"', '"abc"')
+    assert etag_matches('"xyz", "abc"', '"abc"')
+    assert etag_matches('*', '"abc"')
+    assert not etag_matches('"xyz"', '"abc"')
+
+
+def test_stored_upload_digest():
+    assert stored_upload_digest(f'{DIGEST}.jpg') == DIGEST
+    assert stored_upload_digest(f'{DIGEST}_thumbnail_small.jpg') == DIGEST
+    assert stored_upload_digest(DIGEST) == DIGEST
+    assert stored_upload_digest('20240101_120000_photo.jpg') is None
+    assert stored_upload_digest(f'{DIGEST}.jpg/../x') is None
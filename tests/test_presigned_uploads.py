@@ -0,0 +1,147 @@
+import asyncio
+import base64
+import hashlib
+from datetime import datetime
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import pytz
+from fastapi import HTTPException
+
+import main
+from main import UPLOADS_URL, PresignedUpload, S3Storage
+
+moto = pytest.importorskip("moto")
+requests = pytest.importorskip("requests")
+pytest.importorskip("httpx")
+
+BUCKET = 'widechat-test'
+CONTENT = b'%PDF-1.4 direct upload'
+CONTENT_DIGEST = hashlib.sha256(CONTENT).hexdigest()
+CONTENT_KEY = f'{CONTENT_DIGEST}.pdf'
+USER = {'id': 'alice'}
+
+
+class UploadRecord:
+    """Stand-in for an uploads/{sha256} snapshot"""
+    def __init__(self, data=None):
+        self.exists = data is not None
+        self.data = data
+        self.update_time = datetime.now(pytz.utc)
+
+    def to_dict(self):
+        return dict(self.data)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    """An S3Storage backend over moto's in-process S3, wired in as the app's storage"""
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with moto.mock_aws():
+        storage = S3Storage(BUCKET, region='us-east-1')
+        storage.client.create_bucket(Bucket=BUCKET)
+        monkeypatch.setattr(main, 'storage', storage)
+        yield storage
+
+
+@pytest.fixture
+def upload_records(monkeypatch):
+    """uploads/{sha256} records by digest, plus every record written"""
+    records, written = {}, []
+
+    async def get(doc_ref):
+        return UploadRecord(records.get(doc_ref.id))
+
+    async def set(doc_ref, data, merge=False):
+        written.append(data)
+
+    monkeypatch.setattr(main.db, 'collection', lambda name: FakeCollection())
+    monkeypatch.setattr(main.firebase_service, 'get', get)
+    monkeypatch.setattr(main.firebase_service, 'set', set)
+    return records, written
+
+
+class FakeCollection:
+    def document(self, doc_id):
+        doc_ref = mock.MagicMock()
+        doc_ref.id = doc_id
+        return doc_ref
+
+
+def declared(content: bytes = CONTENT, digest: str = CONTENT_DIGEST) -> PresignedUpload:
+    return PresignedUpload(filename='report.pdf', size=len(content), sha256=digest, content_type='application/pdf')
+
+
+def test_presigned_put_is_bound_to_the_checksum(s3, upload_records):
+    presigned = asyncio.run(main.presign_upload(declared(), current_user=USER))
+    assert presigned['complete'] is False and presigned['key'] == CONTENT_KEY
+    checksum = base64.b64encode(bytes.fromhex(CONTENT_DIGEST)).decode()
+    assert presigned['headers']['x-amz-checksum-sha256'] == checksum
+    
+    # The checksum and length are signed, so the client cannot swap in other content
+    signed_headers = parse_qs(urlparse(presigned['upload_url']).query)['X-Amz-SignedHeaders'][0].split(';')
+    assert {'x-amz-checksum-sha256', 'content-length'} <= set(signed_headers)
+    
+    response = requests.put(presigned['upload_url'], data=CONTENT, headers=presigned['headers'])
+    assert response.status_code == 200
+    head = s3.client.head_object(Bucket=BUCKET, Key=CONTENT_KEY)
+    assert head['ContentLength'] == len(CONTENT)
+    assert head['CacheControl'] == main.IMMUTABLE_CACHE_CONTROL
+
+
+def test_complete_registers_a_verified_object(s3, upload_records):
+    _, written = upload_records
+    s3.client.put_object(Bucket=BUCKET, Key=CONTENT_KEY, Body=CONTENT,
+                         ChecksumSHA256=base64.b64encode(bytes.fromhex(CONTENT_DIGEST)).decode())
+    result = asyncio.run(main.complete_presigned_upload(declared(), current_user=USER))
+    assert result['file_url'] == f'{UPLOADS_URL}/{CONTENT_KEY}'
+    assert result['deduplicated'] is False
+    assert written[-1]['stored_name'] == CONTENT_KEY and written[-1]['size'] == len(CONTENT)
+
+
+def test_complete_rejects_a_size_mismatch(s3, upload_records):
+    s3.client.put_object(Bucket=BUCKET, Key=CONTENT_KEY, Body=CONTENT + b'extra')
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.complete_presigned_upload(declared(), current_user=USER))
+    assert error.value.status_code == 400
+    assert asyncio.run(s3.object_size(CONTENT_KEY)) is None
+
+
+def test_complete_rejects_a_checksum_mismatch(s3, upload_records):
+    other = b'%PDF-1.4 something else!'
+    s3.client.put_object(Bucket=BUCKET, Key=CONTENT_KEY, Body=other,
+                         ChecksumSHA256=base64.b64encode(hashlib.sha256(other).digest()).decode())
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.complete_presigned_upload(declared(), current_user=USER))
+    assert error.value.status_code == 400
+    assert asyncio.run(s3.object_size(CONTENT_KEY)) is None
+
+
+def test_complete_without_an_upload_is_not_found(s3, upload_records):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.complete_presigned_upload(declared(), current_user=USER))
+    assert error.value.status_code == 404
+
+
+def test_presign_reuses_a_stored_digest(s3, upload_records):
+    records, _ = upload_records
+    s3.client.put_object(Bucket=BUCKET, Key=CONTENT_KEY, Body=CONTENT)
+    records[CONTENT_DIGEST] = {'stored_name': CONTENT_KEY, 'ref_count': 3, 'variants': {}}
+    result = asyncio.run(main.presign_upload(declared(), current_user=USER))
+    assert result['complete'] is True and result['deduplicated'] is True
+    assert result['file_url'] == f'{UPLOADS_URL}/{CONTENT_KEY}'
+    assert 'upload_url' not in result
+
+
+def test_remote_media_is_served_through_a_presigned_redirect(s3):
+    from fastapi.testclient import TestClient
+    
+    s3.client.put_object(Bucket=BUCKET, Key=CONTENT_KEY, Body=CONTENT)
+    response = TestClient(main.app).get(f'/uploads/{CONTENT_KEY}', follow_redirects=False)
+    assert response.status_code == 307
+    location = response.headers['location']
+    assert f'/{BUCKET}/{CONTENT_KEY}' in location or f'{BUCKET}.s3' in location
+    assert 'X-Amz-Signature=' in location
+    assert requests.get(location).content == CONTENT
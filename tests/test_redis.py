@@ -0,0 +1,154 @@
+import asyncio
+import time
+
+import pytest
+import redis.asyncio
+
+import main
+from main import AuthCache, CacheInvalidationBus, RedisPresenceStore
+
+fakeredis = pytest.importorskip("fakeredis")
+
+REDIS_URL = "redis://redis.test:6379/0"
+
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    """One in-memory Redis shared by every client, as separate nodes would share a real one"""
+    server = fakeredis.FakeServer()
+
+    def connect(url, **kwargs):
+        return fakeredis.aioredis.FakeRedis(server=server)
+
+    monkeypatch.setattr(redis.asyncio, 'from_url', connect)
+    monkeypatch.setattr(redis.asyncio.Redis, 'from_url', staticmethod(connect))
+    return server
+
+
+async def eventually(predicate, timeout: float = 2.0):
+    """Wait for predicate() (plain or async) to become true"""
+    deadline = time.monotonic() + timeout
+    while True:
+        result = predicate()
+        if asyncio.iscoroutine(result):
+            result = await result
+        if result:
+            return
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not reached in time")
+        await asyncio.sleep(0.01)
+
+
+async def subscribed(channel: str, count: int) -> bool:
+    client = redis.asyncio.from_url(REDIS_URL)
+    return dict(await client.pubsub_numsub(channel)).get(channel.encode(), 0) >= count
+
+
+def test_emit_reaches_a_client_connected_to_another_node(redis_server):
+    async def scenario():
+        node_a = main.create_socket_server(REDIS_URL)
+        node_b = main.create_socket_server(REDIS_URL)
+        assert isinstance(node_b.manager, main.socketio.AsyncRedisManager)
+        
+        delivered = []
+
+        async def emit_internal(eio_sid, event, data, namespace=None, id=None):
+            delivered.append((eio_sid, event, data))
+
+        node_b._emit_internal = emit_internal
+        node_b.manager.initialize()
+        sid = node_b.manager.connect('eio-bob', '/')
+        node_b.manager.enter_room(sid, '/', 'user_bob')
+        await eventually(lambda: subscribed('socketio', 1))
+        
+        await node_a.emit('new_message', {'id': 'msg-1'}, room='user_bob')
+        await eventually(lambda: delivered)
+        node_b.manager.thread.cancel()
+        return delivered
+
+    assert asyncio.run(scenario()) == [('eio-bob', 'new_message', {'id': 'msg-1'})]
+
+
+def test_device_counts_are_shared_between_nodes(redis_server, monkeypatch):
+    async def scenario():
+        node_a, node_b = RedisPresenceStore(REDIS_URL), RedisPresenceStore(REDIS_URL)
+        monkeypatch.setattr(main, 'NODE_ID', 'node-a')
+        await node_a.touch('alice')
+        await node_a.set_devices('alice', 2)
+        monkeypatch.setattr(main, 'NODE_ID', 'node-b')
+        await node_b.set_devices('alice', 1)
+        
+        assert await node_b.device_count('alice') == 3
+        assert await node_b.online_among(['alice', 'bob']) == {'alice'}
+        
+        # node-b's last device leaves, as disconnect does it
+        await node_b.set_devices('alice', 0)
+        await node_b.remove('alice')
+        assert await node_a.device_count('alice') == 2
+        
+        # A node that shuts down withdraws what it held
+        monkeypatch.setattr(main, 'NODE_ID', 'node-a')
+        await node_a.close()
+        assert await node_b.device_count('alice') == 0
+        assert await node_b.online_among(['alice']) == set()
+
+    asyncio.run(scenario())
+
+
+def test_counts_of_a_dead_node_lapse_with_its_presence(redis_server, monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(main, 'NODE_ID', 'node-a')
+        store = RedisPresenceStore(REDIS_URL)
+        await store.set_devices('alice', 1)
+        assert await store.device_count('alice') == 1
+        
+        # The node stopped renewing: its member is past its expiry
+        await store.redis.zadd('presence:alice', {'node-a': time.time() - 1})
+        assert await store.device_count('alice') == 0
+        
+        # A live node renews for users it holds devices for, heartbeats or not
+        await store.renew()
+        assert await store.device_count('alice') == 1
+
+    asyncio.run(scenario())
+
+
+def test_invalidations_reach_other_nodes_only(redis_server):
+    async def scenario():
+        node_a, node_b = CacheInvalidationBus(REDIS_URL), CacheInvalidationBus(REDIS_URL)
+        node_a.node_id, node_b.node_id = 'node-a', 'node-b'
+        received = {'node-a': [], 'node-b': []}
+        node_a.register('auth', received['node-a'].append)
+        node_b.register('auth', received['node-b'].append)
+        listeners = [asyncio.create_task(node_a.listen()), asyncio.create_task(node_b.listen())]
+        await eventually(lambda: subscribed(main.CACHE_INVALIDATION_CHANNEL, 2))
+        
+        node_a.publish('auth', 'alice')
+        node_a.publish('connection_graph', 'alice')
+        await eventually(lambda: received['node-b'])
+        await asyncio.sleep(0.05)
+        for listener in listeners:
+            listener.cancel()
+        return received
+
+    assert asyncio.run(scenario()) == {'node-a': [], 'node-b': ['alice']}
+
+
+def test_auth_cache_publishes_its_own_invalidations_only(monkeypatch):
+    published = []
+    monkeypatch.setattr(main.cache_bus, 'publish', lambda kind, user_id: published.append((kind, user_id)))
+    auth_cache = AuthCache(ttl=300, revocation_interval=60, max_entries=3)
+    auth_cache.put('token-1', {'uid': 'alice', 'exp': time.time() + 3600}, {'id': 'alice'})
+    
+    auth_cache.invalidate_user('alice', publish=False)
+    assert published == []
+    assert auth_cache.get('token-1') is None
+    auth_cache.invalidate_user('alice')
+    assert published == [('auth', 'alice')]
+
+
+def test_without_redis_nothing_is_published():
+    bus = CacheInvalidationBus(None)
+    bus.publish('auth', 'alice')
+    assert bus.tasks == set()
+    assert isinstance(main.create_socket_server(None).manager, main.socketio.AsyncManager)
@@ -0,0 +1,26 @@
+from main import score_search_match, search_tokens
+
+
+def test_search_tokens_include_prefixes_of_normalized_words():
+    tokens = search_tokens('Café Hello')
+    assert {'cafe', 'ca', 'caf', 'hello', 'he', 'hel', 'hell'} <= set(tokens)
+    assert 'c' not in tokens
+    assert len(tokens) == len(set(tokens))
+
+
+def test_search_tokens_cap_prefix_length():
+    word = 'a' * 20 + 'b'
+    tokens = search_tokens(word)
+    assert word in tokens
+    assert max(len(token) for token in tokens if token != word) == 12
+
+
+def test_score_prefers_exact_matches_over_prefixes():
+    words = ['hello', 'world']
+    assert score_search_match(['hello', 'world'], words) == 4
+    assert score_search_match(['hel', 'world'], words) == 3
+    assert score_search_match(['hel', 'wor'], words) == 2
+
+
+def test_score_requires_every_term():
+    assert score_search_match(['hello', 'missing'], ['hello', 'world']) == 0
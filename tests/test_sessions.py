@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+import main
+from main import SessionRegistry
+
+
+def test_first_and_last_device():
+    sessions = SessionRegistry()
+    _, first = sessions.add('alice', 'sid-1')
+    _, second = sessions.add('alice', 'sid-2')
+    assert first and not second
+    assert sessions.device_count('alice') == 2
+
+    record, last = sessions.remove('sid-1')
+    assert record.user_id == 'alice' and not last
+    assert not record.active
+    _, last = sessions.remove('sid-2')
+    assert last
+    assert sessions.device_count('alice') == 0
+    assert sessions.remove('sid-2') == (None, False)
+
+
+def test_rejoining_the_same_sid_keeps_its_record():
+    sessions = SessionRegistry()
+    record, _ = sessions.add('alice', 'sid-1')
+    again, first = sessions.add('alice', 'sid-1')
+    assert again is record and not first
+    assert sessions.device_count('alice') == 1
+
+
+def test_sid_reused_by_another_user_moves_over():
+    sessions = SessionRegistry()
+    sessions.add('alice', 'sid-1')
+    record, first = sessions.add('bob', 'sid-1')
+    assert first and record.user_id == 'bob'
+    assert sessions.device_count('alice') == 0
+    assert sessions.get('sid-1') is record
+
+
+class OtherNodesStore(main.LocalPresenceStore):
+    """Local store that also reports devices held by other nodes"""
+    def __init__(self, elsewhere: int):
+        super().__init__()
+        self.elsewhere = elsewhere
+
+    async def device_count(self, user_id: str) -> int:
+        return await super().device_count(user_id) + self.elsewhere
+
+
+@pytest.fixture
+def transitions(monkeypatch):
+    events = []
+
+    async def update_user_status(user_id, is_online):
+        events.append(('status', user_id, is_online))
+
+    async def emit_presence(event, user_id, payload, skip_sid=None):
+        events.append((event, user_id))
+
+    async def get_socket_user_id(sid):
+        return 'alice'
+
+    monkeypatch.setattr(main, 'sessions', SessionRegistry())
+    monkeypatch.setattr(main, 'update_user_status', update_user_status)
+    monkeypatch.setattr(main, 'emit_presence', emit_presence)
+    monkeypatch.setattr(main, 'get_socket_user_id', get_socket_user_id)
+    monkeypatch.setattr(main.sio, 'enter_room', lambda *args, **kwargs: None)
+    return events
+
+
+def test_last_device_anywhere_goes_offline(transitions, monkeypatch):
+    monkeypatch.setattr(main.presence, 'store', OtherNodesStore(elsewhere=0))
+    asyncio.run(main.join_room('sid-1'))
+    asyncio.run(main.disconnect('sid-1'))
+    assert ('user_online', 'alice') in transitions
+    assert transitions[-2:] == [('status', 'alice', False), ('user_offline', 'alice')]
+
+
+def test_devices_on_other_nodes_keep_the_user_online(transitions, monkeypatch):
+    monkeypatch.setattr(main.presence, 'store', OtherNodesStore(elsewhere=1))
+    asyncio.run(main.join_room('sid-1'))
+    asyncio.run(main.disconnect('sid-1'))
+    assert ('user_online', 'alice') not in transitions
+    assert ('user_offline', 'alice') not in transitions
+    assert ('status', 'alice', False) not in transitions
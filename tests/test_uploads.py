@@ -0,0 +1,32 @@
+import pytest
+
+from main import UPLOAD_MAX_BYTES, UPLOAD_MULTIPART_OVERHEAD, UPLOADS_URL, app, upload_digest, upload_key
+
+DIGEST = 'ab' * 32
+
+
+def test_upload_key():
+    assert upload_key(f'{UPLOADS_URL}/{DIGEST}.png') == f'{DIGEST}.png'
+    assert upload_key(f'/uploads/{DIGEST}.png') == f'{DIGEST}.png'
+    assert upload_key(f'https://elsewhere.example/uploads/{DIGEST}.png') is None
+    assert upload_key(f'{UPLOADS_URL}/../secret') is None
+    assert upload_key(f'{UPLOADS_URL}/.env') is None
+    assert upload_key(f'{UPLOADS_URL}/') is None
+    assert upload_key(None) is None
+
+
+def test_upload_digest_only_for_content_addressed_urls():
+    assert upload_digest(f'{UPLOADS_URL}/{DIGEST}.png') == DIGEST
+    assert upload_digest(f'{UPLOADS_URL}/legacy_photo.png') is None
+    assert upload_digest(f'https://elsewhere.example/{DIGEST}.png') is None
+
+
+def test_upload_without_content_length_is_refused():
+    testclient = pytest.importorskip("fastapi.testclient")
+    client = testclient.TestClient(app)
+    chunked = client.post('/upload', content=iter([b'--x\r\n', b'data']),
+                          headers={'content-type': 'multipart/form-data; boundary=x'})
+    assert chunked.status_code == 411
+    oversized = client.post('/upload', content=b'x',
+                            headers={'content-length': str(UPLOAD_MAX_BYTES + UPLOAD_MULTIPART_OVERHEAD + 1)})
+    assert oversized.status_code == 413